@@ -0,0 +1,817 @@
+###############################################################################
+##
+## benchmarks.py
+##
+##   Microbenchmarks (each with a check that the optimized code produces the
+##   same results as the code it replaces) for the data processing stages.
+##   Benchmarks use the entries in a data set file if one is specified, and
+##   results can be saved and compared against those of an earlier run, e.g.:
+##
+##     python benchmarks.py dimension_scan projection -i data.json -save before.json
+##     python benchmarks.py projection -i data.json -compare before.json
+##
+##   The stages benchmark runs every stage of the pipeline on synthetic
+##   catalogs of several sizes, recording the time and peak memory of each:
+##
+##     python benchmarks.py stages -sizes 1000 10000 -save stages.json
+##
+##
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import warnings
+from fractions import Fraction
+
+import data # Project-specific package.
+import export # Project-specific package.
+import measurements # Project-specific package.
+from entries import entries_read, entries_write # Project-specific package.
+
+###############################################################################
+##
+
+# Dimension strings (after normalization) used when no data set is specified.
+SAMPLE_DIMENSIONS = [
+    "w80 x d40 x h120", "60x120", "120", "45.5", "w 80 d 40", "b80 t40 h120",
+    "l9'-10'", "5'3\"", "h26 3/4", "d 15 3/4", "w31 1/2 x d11 3/8 x h79 1/2",
+    "diameter 30", "5 x 10.5", "larg. 80 prof. 40", "2.5 1/2", "1/2",
+    "3 1/2-4", "12x12x12", "140/160/180/200", "w40/60/80/100/120/140/160/180/200",
+    "w 100-200 x l 80-160 x h 74", "44 5/62", "l220-l56.5", "2 thick"
+]
+
+def sample_entries():
+    '''
+    Entries combining every sample dimension string with every country
+    and a few units and quantities.
+    '''
+    units = ["cm", "in", "mm", None]
+    quantities = ["2 pieces", "pair", "piece", 4, "100 g", None]
+    pairs = [(country, dimension) for country in data.CONFIG['countries'] for dimension in SAMPLE_DIMENSIONS]
+    return [{'country': country, 'dim1': dimension, 'unit': units[i % len(units)], 'quantity': quantities[i % len(quantities)]}\
+            for (i, (country, dimension)) in enumerate(pairs)]
+
+def dimension_strings(json_file):
+    '''
+    Retrieve the normalized dimension strings of every entry in a data set.
+    '''
+    dimensions = []
+    for entry in entries_read(json_file):
+        for column in ["dim1", "dim2", "dim3", "other-measurement-1"]:
+            if entry.get(column) not in {None, "", "n/a"}:
+                (dimension, dim_label) = data.projection_geometry_dimension_normalize(entry['country'], entry[column])
+                dimensions.append(dimension)
+    return dimensions
+
+def time_per_item(f, items, repeat):
+    '''
+    Best time (in microseconds) per item for applying a function to every item.
+    '''
+    seconds = min(timeit.repeat(lambda: [f(item) for item in items], number = 1, repeat = repeat))
+    return 1000000 * seconds / max(1, len(items))
+
+def benchmark_dimension_scan(dimensions, repeat = 5):
+    '''
+    Check that project_geometry_dimension_scan finds the same matches as
+    project_geometry_dimension_matches on every dimension string, and then
+    compare their running times.
+    '''
+    for dimension in dimensions:
+        expected = data.project_geometry_dimension_matches(data.CONFIG['numerical'], dimension)
+        actual = data.project_geometry_dimension_scan(data.RULES.numerical, dimension)
+        if (expected.raws(), expected.notations()) != (actual.raws(), actual.notations()):
+            raise AssertionError("Scanner mismatch on '" + dimension + "': "\
+                                 + str(list(zip(expected.raws(), expected.notations()))) + " != "\
+                                 + str(list(zip(actual.raws(), actual.notations()))))
+    before = time_per_item(lambda d: data.project_geometry_dimension_matches(data.CONFIG['numerical'], d), dimensions, repeat)
+    after = time_per_item(lambda d: data.project_geometry_dimension_scan(data.RULES.numerical, d), dimensions, repeat)
+    return {'benchmark': 'dimension_scan', 'items': len(dimensions), 'us_per_item': after, 'reference_us_per_item': before, 'speedup': before / after}
+
+def benchmark_projection(entries, repeat = 5):
+    '''
+    Time projection_add on every entry (on fresh copies of the entries in
+    every repetition, and without the dimension cache, so that every entry
+    goes through the projection rules).
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        copies = [dict(entry) for entry in entries]
+        start = time.perf_counter()
+        for entry in copies:
+            data.projection_add(entry)
+        best = min(best, time.perf_counter() - start)
+    return {'benchmark': 'projection', 'items': len(entries), 'us_per_item': 1000000 * best / max(1, len(entries))}
+
+def benchmark_unit_conversion(dimensions, repeat = 5):
+    '''
+    Check that measurements_convert computes the same values as converting
+    each Measurement on its own for every dimension string matched in every
+    unit (and assortments_convert the same extremes for every assortment),
+    and then compare their running times.
+    '''
+    assortments = sorted([data.project_geometry_dimension_scan(data.RULES.numerical, dimension) for dimension in dimensions], key = len)
+    (raws, notations, units) = ([], [], [])
+    for unit in ["mm", "cm", "m", "in", "ft"]:
+        for assortment in assortments:
+            raws.extend(assortment.raws())
+            notations.extend(assortment.notations())
+            units.extend([unit] * len(assortment))
+    def scalar():
+        values = []
+        for (raw, notation, unit) in zip(raws, notations, units):
+            m = measurements.Measurement(raw, notation)
+            values.append((m.cm, m.inches) if m.set_unit(unit) else None)
+        return values
+    (cms, inches, valid) = measurements.measurements_convert(raws, notations, units)
+    for (i, expected) in enumerate(scalar()):
+        actual = (float(cms[i]), float(inches[i])) if valid[i] else None
+        if expected != actual:
+            raise AssertionError("Conversion mismatch on '" + raws[i] + "' (" + notations[i] + ", " + units[i] + "): "\
+                                 + str(expected) + " != " + str(actual))
+    # Check assortments_convert against the same values per assortment,
+    # with an empty assortment after every one (including the last, so that
+    # the longest assortments come last).
+    offsets = [0]
+    for unit in ["mm", "cm", "m", "in", "ft"]:
+        for assortment in assortments:
+            offsets.extend([offsets[-1] + len(assortment)] * 2)
+    (converted, min_cm, max_cm) = measurements.assortments_convert(raws, notations, units, offsets)
+    values = scalar()
+    for i in range(len(offsets) - 1):
+        group = values[offsets[i]:offsets[i + 1]]
+        expected = (min(v[0] for v in group), max(v[0] for v in group)) if len(group) > 0 and None not in group else None
+        actual = (float(min_cm[i]), float(max_cm[i])) if converted[i] else None
+        if expected != actual:
+            raise AssertionError("Assortment conversion mismatch on " + str(raws[offsets[i]:offsets[i + 1]]) + " (" + units[offsets[i]] + "): "\
+                                 + str(expected) + " != " + str(actual))
+    before = min(timeit.repeat(scalar, number = 1, repeat = repeat))
+    after = min(timeit.repeat(lambda: measurements.measurements_convert(raws, notations, units), number = 1, repeat = repeat))
+    per_item = lambda seconds: 1000000 * seconds / max(1, len(raws))
+    return {'benchmark': 'unit_conversion', 'items': len(raws), 'us_per_item': per_item(after), 'reference_us_per_item': per_item(before), 'speedup': before / after}
+
+def grouping_entries(names = 5, per_name = 2000, seed = 0):
+    '''
+    Entries for a few names with thousands of entries each, with (max_cm,
+    min_cm) points scattered around many sizes, as in the largest names
+    in the data set.
+    '''
+    generator = random.Random(seed)
+    entries = []
+    for n in range(names):
+        sizes = [(generator.uniform(20, 400), generator.uniform(5, 200)) for _ in range(per_name // 20)]
+        for _ in range(per_name):
+            (x, y) = generator.choice(sizes)
+            (x, y) = (round(x + generator.gauss(0, 2), 1), round(y + generator.gauss(0, 2), 1))
+            entries.append({'name': "name" + str(n), 'max_cm': max(x, y), 'min_cm': min(x, y)})
+    return entries
+
+def ad_hoc_groups_reference(entries):
+    '''
+    The groups of the entries as derived by the original implementation of
+    derive_ad_hoc_groups, which compares every point with every mean.
+    '''
+    points = {}
+    for e in entries:
+        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+            name = e.get('name')
+            p = (name, e['max_cm'], e['min_cm'])
+            if not name in points:
+                points[name] = [p]
+            else:
+                (dist, i) = data.chebyshev_closest(p, points[name])
+                if dist < 3:
+                    q = points[name][i]
+                    points[name][i] = (p[0], (p[1]+q[1])/2, (p[2]+q[2])/2)
+                else:
+                    points[name].append(p)
+    groups = []
+    for e in entries:
+        group = None
+        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+            name = e.get('name')
+            (dist, i) = data.chebyshev_closest((name, e['max_cm'], e['min_cm']), points[name])
+            if dist < 3:
+                group = "_".join([str(x) for x in points[name][i]])
+        groups.append(group)
+    return groups
+
+def ad_hoc_groups(entries):
+    points = data.ad_hoc_centroids(entries)
+    return [data.ad_hoc_group(points, dict(e)).get('group') for e in entries]
+
+def benchmark_grouping(entries, repeat = 3):
+    '''
+    Check that the centroid index derives the same groups as the original
+    implementation, and then compare their running times.
+    '''
+    expected = ad_hoc_groups_reference(entries)
+    actual = ad_hoc_groups(entries)
+    mismatches = [i for i in range(len(entries)) if expected[i] != actual[i]]
+    if len(mismatches) > 0:
+        i = mismatches[0]
+        raise AssertionError("Group mismatch on " + str(entries[i]) + ": " + str(expected[i]) + " != " + str(actual[i]))
+    before = min(timeit.repeat(lambda: ad_hoc_groups_reference(entries), number = 1, repeat = repeat))
+    after = min(timeit.repeat(lambda: ad_hoc_groups(entries), number = 1, repeat = repeat))
+    per_item = lambda seconds: 1000000 * seconds / max(1, len(entries))
+    return {'benchmark': 'grouping', 'items': len(entries), 'us_per_item': per_item(after), 'reference_us_per_item': per_item(before), 'speedup': before / after}
+
+def sweep_points(entries = None, seed = 0):
+    '''
+    The (max_cm, min_cm) points of the name with the most entries in a data
+    set, or clustered synthetic points if no entries are specified.
+    '''
+    import numpy as np
+    if entries is None:
+        generator = np.random.default_rng(seed)
+        centers = generator.uniform(0, 300, size = (30, 2))
+        return np.vstack([generator.normal(c, 3, size = (200, 2)) for c in centers])
+    by_name = {}
+    for e in entries:
+        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+            by_name.setdefault(e['name'], []).append([e['max_cm'], e['min_cm']])
+    return np.array(max(by_name.values(), key = len), dtype = float)
+
+def benchmark_kmeans_sweep(points, ks = range(2, 41, 2), repeat = 3):
+    '''
+    Compare a warm-started sweep over k with fitting every k from scratch
+    (reporting the ratio of the total errors of the two).
+    '''
+    import kmeans # Project-specific package (only needed for this benchmark).
+    from sklearn.cluster import KMeans
+    ks = [k for k in ks if k <= len(points)]
+    cold = lambda: {k: KMeans(init = 'k-means++', n_clusters = k).fit(points).inertia_ for k in ks}
+    warm = lambda: kmeans.sweepKmeans(points, ks)[0]
+    ratio = sum(warm().values()) / sum(cold().values())
+    before = min(timeit.repeat(cold, number = 1, repeat = repeat))
+    after = min(timeit.repeat(warm, number = 1, repeat = repeat))
+    per_item = lambda seconds: 1000000 * seconds / max(1, len(ks))
+    return {'benchmark': 'kmeans_sweep', 'items': len(ks), 'us_per_item': per_item(after), 'reference_us_per_item': per_item(before), 'speedup': before / after, 'error_ratio': ratio}
+
+def xlsx_reference(json_file, xlsx_file, dimensions):
+    '''
+    The original XLSX writer, which holds the workbook in memory and
+    writes every cell separately.
+    '''
+    import xlsxwriter
+    entries = list(entries_read(json_file))
+    xl_workbook = xlsxwriter.Workbook(xlsx_file)
+    xl_bold = xl_workbook.add_format({'bold': True})
+    xl_row_evn = xl_workbook.add_format({'bg_color':'#FFFFFF'})
+    xl_row_odd = xl_workbook.add_format({'bg_color':'#EAEAEA'})
+    xl_row_non = xl_workbook.add_format({'bg_color':'#FBFFD8'})
+    xl_sheet = xl_workbook.add_worksheet("data")
+    groups = sorted({e['group'] for e in entries if e.get('group') is not None})
+    group_to_index = {g:i for (i, g) in enumerate(groups)}
+    for (i,w) in zip(range(0,11), [2,5,10,25,18,8,4,4.5,5.5,6.5,8]):
+        xl_sheet.set_column(i, i, w)
+    for i in range(0,len(dimensions)):
+        xl_sheet.write(0, i, dimensions[i], xl_bold)
+    for (i, entry) in enumerate(entries):
+        fmt = xl_row_non
+        if entry.get('group') is not None:
+            fmt = xl_row_evn if ((group_to_index[entry['group']])%2==0) else xl_row_odd
+        for j in range(0,len(dimensions)):
+            xl_sheet.write(i+1, j, entry.get(dimensions[j]), fmt)
+    xl_workbook.close()
+
+def xlsx_values(xlsx_file):
+    import openpyxl
+    return [[c.value for c in row] for sheet in openpyxl.load_workbook(xlsx_file, read_only = True) for row in sheet.iter_rows()]
+
+def benchmark_export(json_file = None, repeat = 3):
+    '''
+    Check that export_xlsx writes the same cells as the original writer
+    (if openpyxl is available to read them back), and then compare their
+    running times along with those of the CSV and columnar exporters.
+    Without a data set file, the grouped sample entries are used.
+    '''
+    dimensions = data.CONFIG['dimensions']
+    with tempfile.TemporaryDirectory() as directory:
+        if json_file is None:
+            json_file = os.path.join(directory, "grouped.jsonl")
+            entries = grouping_entries()
+            points = data.ad_hoc_centroids(entries)
+            entries_write(json_file, (data.ad_hoc_group(points, e) for e in entries))
+        count = sum(1 for _ in entries_read(json_file))
+        (before_file, after_file) = (os.path.join(directory, "before.xlsx"), os.path.join(directory, "after.xlsx"))
+        xlsx_reference(json_file, before_file, dimensions)
+        export.export_xlsx(json_file, after_file, dimensions)
+        try:
+            if xlsx_values(before_file) != xlsx_values(after_file):
+                raise AssertionError("Spreadsheet mismatch on '" + json_file + "'")
+        except ImportError:
+            pass
+        time_of = lambda f: min(timeit.repeat(f, number = 1, repeat = repeat))
+        before = time_of(lambda: xlsx_reference(json_file, before_file, dimensions))
+        after = time_of(lambda: export.export_xlsx(json_file, after_file, dimensions))
+        csv = time_of(lambda: export.export_csv(json_file, os.path.join(directory, "export.csv"), dimensions))
+        store = time_of(lambda: export.export_store(json_file, os.path.join(directory, "export.store"), dimensions))
+    per_item = lambda seconds: 1000000 * seconds / max(1, count)
+    return {'benchmark': 'export', 'items': count, 'us_per_item': per_item(after), 'reference_us_per_item': per_item(before), 'speedup': before / after,\
+            'csv_us_per_item': per_item(csv), 'store_us_per_item': per_item(store)}
+
+def json_to_color_map_reference(input, output):
+    '''
+    The original json_to_color_map, which normalizes every color with
+    chained replacements and builds nested dictionaries of all colors.
+    '''
+    from collections import defaultdict
+    CONFIG = data.CONFIG
+    ikeaid_year_country_to_color = {}
+    for entry in entries_read(input):
+        (ikeaid, year, country) = (entry.get('ikeaid'), str(entry.get('year')), entry.get('country'))
+        if ikeaid is not None and ikeaid != "n/a" and entry.get("color") != "n/a":
+            color = entry.get("color")
+            if country in {'us','uk','ca'}:
+                color = color\
+                  .replace(' and ', ' & ')\
+                  .replace(', in', ' in')\
+                  .replace(', ', ' & ')\
+                  .replace('/', ' & ')\
+                  .replace('& &', '&')\
+                  .replace('-', ' ')\
+                  .strip()
+                for (text, fix) in CONFIG['corrections']['colors']['en']:
+                    color = color.replace(text, fix)
+            color = data.color_normalize(color)
+            ikeaid_year_country_to_color.setdefault(ikeaid, {})
+            ikeaid_year_country_to_color[ikeaid].setdefault(year, {})
+            ikeaid_year_country_to_color[ikeaid][year].setdefault(country, [])
+            ikeaid_year_country_to_color[ikeaid][year][country].append(color)
+    ensembles = set()
+    for ikeaid in ikeaid_year_country_to_color:
+        for year in ikeaid_year_country_to_color[ikeaid]:
+            by_country = ikeaid_year_country_to_color[ikeaid][year]
+            if len(by_country) == 7:
+                if None not in [by_country[c][0] for c in by_country]:
+                    ensembles.add(tuple([(c, data.str_ascii_only(by_country[c][0])) for c in by_country]))
+    country_color_to_translation = {}
+    for ensemble in ensembles:
+        for (country, color) in ensemble:
+            if country not in {'us','uk','ca'} and not any(s in color for s in ["/", ",", ".", " e ", " and ", " oder ", " und ", " et "]):
+                color = color.replace('-', ' ')
+                country_color_to_translation.setdefault((country, color), [])
+                country_color_to_translation[(country, color)].extend([col for (cntry, col) in ensemble if cntry in {'us','uk'}])
+    web_translations = json.loads(open('colors.translations.json', 'r').read())
+    country_color_to_ensembles = {}
+    for (country, color) in country_color_to_translation:
+        freqs = defaultdict(int)
+        freqs[web_translations[country][data.color_normalize(color)]] = float('inf')
+        for translation in country_color_to_translation[(country, color)]:
+           freqs[translation] += 1
+        country_color_to_ensembles.setdefault(country, {})
+        country_color_to_ensembles[country][color] = list(reversed([[t, f] for (f, t) in sorted([(freqs[t], t) for t in freqs])]))
+    raw = json.dumps(country_color_to_ensembles, sort_keys=True, indent=2)
+    raw = raw.replace(",\n        ", ", ").replace("[\n        ", "[").replace("\n      ]", "]")
+    open(output, 'w').write(raw)
+
+def color_normalize_reference(country, color):
+    '''
+    The normalization of a color by the original json_to_color_map (along
+    with the conversion to ASCII of the colors in its ensembles).
+    '''
+    if country in {'us','uk','ca'}:
+        color = color.replace(' and ', ' & ').replace(', in', ' in').replace(', ', ' & ').replace('/', ' & ').replace('& &', '&').replace('-', ' ').strip()
+        for (text, fix) in data.CONFIG['corrections']['colors']['en']:
+            color = color.replace(text, fix)
+    return data.str_ascii_only(data.color_normalize(color))
+
+def benchmark_color_map(json_file = None, repeat = 3, size = 20000):
+    '''
+    Check that json_to_color_map writes the same color mapping (and that
+    ColorNormalizer normalizes every color in the same way) as the original
+    implementation, and then compare the running times of the whole stage
+    and of the normalization of the colors alone. Without a data set file,
+    a synthetic catalog of the given size is ingested.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        if json_file is None:
+            json_file = os.path.join(directory, "data.json")
+            synthetic_catalog(os.path.join(directory, "catalog"), size)
+            with contextlib.redirect_stdout(io.StringIO()):
+                data.xlsx_files_to_json_file(os.path.join(directory, "catalog", ""), json_file)
+        count = sum(1 for _ in entries_read(json_file))
+        (before_file, after_file) = (os.path.join(directory, "before.json"), os.path.join(directory, "after.json"))
+        json_to_color_map_reference(json_file, before_file)
+        data.json_to_color_map(json_file, after_file)
+        if open(before_file).read() != open(after_file).read():
+            raise AssertionError("Color mapping mismatch on '" + json_file + "'")
+        colors = [(e.get('country'), e['color']) for e in entries_read(json_file) if type(e.get('color')) == str and e['color'] != "n/a"]
+        normalizer = data.ColorNormalizer(data.CONFIG['corrections']['colors']['en'])
+        for (country, color) in colors:
+            if normalizer.normalize(country, color) != color_normalize_reference(country, color):
+                raise AssertionError("Color mismatch on '" + color + "' (" + str(country) + ")")
+        before = min(timeit.repeat(lambda: json_to_color_map_reference(json_file, before_file), number = 1, repeat = repeat))
+        after = min(timeit.repeat(lambda: data.json_to_color_map(json_file, after_file), number = 1, repeat = repeat))
+        normalize = lambda n: [n.normalize(country, color) for (country, color) in colors]
+        normalize_before = min(timeit.repeat(lambda: [color_normalize_reference(country, color) for (country, color) in colors], number = 1, repeat = repeat))
+        normalize_after = min(timeit.repeat(lambda: normalize(data.ColorNormalizer(data.CONFIG['corrections']['colors']['en'])), number = 1, repeat = repeat))
+    per_item = lambda seconds, items: 1000000 * seconds / max(1, items)
+    return {'benchmark': 'color_map', 'items': count, 'us_per_item': per_item(after, count), 'reference_us_per_item': per_item(before, count), 'speedup': before / after,\
+            'normalize_us_per_item': per_item(normalize_after, len(colors)), 'reference_normalize_us_per_item': per_item(normalize_before, len(colors)),\
+            'normalize_speedup': normalize_before / normalize_after}
+
+# Dependencies that the cheap subcommands of cli.py should not import.
+STARTUP_HEAVY_MODULES = ["sklearn", "scipy", "pandas", "matplotlib", "openpyxl"]
+
+def startup_commands(json_file, directory):
+    return [
+        ["partition", json_file, "-container", os.path.join(directory, "partitions")],
+        ["summary", json_file, os.path.join(directory, "summary.json")],
+        ["csv", json_file, os.path.join(directory, "export.csv")],
+        ["store", json_file, os.path.join(directory, "export.store")]
+    ]
+
+def startup_run(command, directory, preamble = ""):
+    '''
+    Run a subcommand of cli.py in a new process (in the given working
+    directory), returning the modules it imported and the time it took.
+    '''
+    package = os.path.dirname(os.path.abspath(__file__))
+    config = os.path.join(package, "config.json")
+    code = "import json, sys; sys.path.insert(0, sys.argv[1]); " + preamble + "import cli; cli.main(sys.argv[2:]); print(json.dumps(sorted(sys.modules)))"
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code, package, "-config", config] + command, cwd = directory, check = True, capture_output = True, text = True).stdout
+    return (json.loads(output.splitlines()[-1]), time.perf_counter() - start)
+
+def benchmark_startup(json_file = None, repeat = 5):
+    '''
+    Check that the cheap subcommands of cli.py do not import the heavy
+    dependencies, and then compare the time each takes in a new process
+    (from startup to exit) with the time it takes when those dependencies
+    are imported eagerly, as kmeans.py used to. Without a data set file,
+    the grouping entries are used.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        if json_file is None:
+            json_file = os.path.join(directory, "grouped.jsonl")
+            entries_write(json_file, grouping_entries(per_name = 200))
+        json_file = os.path.abspath(json_file)
+        eager = "import " + ", ".join(["sklearn.cluster", "scipy.spatial.distance", "pandas", "matplotlib.pyplot", "openpyxl"]) + "; "
+        (before, after, seconds) = (0, 0, {})
+        for command in startup_commands(json_file, directory):
+            (modules, _) = startup_run(command, directory)
+            heavy = [m for m in STARTUP_HEAVY_MODULES if m in modules]
+            if len(heavy) > 0:
+                raise AssertionError("Subcommand '" + command[0] + "' imported " + ", ".join(heavy))
+            seconds[command[0]] = min(startup_run(command, directory)[1] for _ in range(repeat))
+            after += seconds[command[0]]
+            before += min(startup_run(command, directory, eager)[1] for _ in range(repeat))
+    per_item = lambda s: 1000000 * s / len(seconds)
+    return {'benchmark': 'startup', 'items': len(seconds), 'us_per_item': per_item(after), 'reference_us_per_item': per_item(before), 'speedup': before / after,\
+            'seconds': seconds}
+
+###############################################################################
+##  Synthetic catalogs and the end-to-end stage benchmarks.
+
+SYNTHETIC_SYLLABLES = ["bil", "ly", "lack", "ek", "torp", "mal", "hem", "nes", "kal", "lax", "i", "var", "ler", "berg",\
+                       "po", "ang", "fro", "sta", "tar", "va", "sko", "gen", "ro", "ast", "ful", "len", "so", "dal"]
+SYNTHETIC_KINDS = ["bookcase", "table", "chair", "shelf", "frame", "rug", "lamp", "bowl", "curtains", "box"]
+SYNTHETIC_PRICES = {'us': 1.0, 'uk': 0.7, 'ca': 1.2, 'de': 0.9, 'se': 8.0, 'it': 0.9, 'fr': 0.9}
+
+def synthetic_colors():
+    '''
+    Colors with a web translation (without conjunctions or separators) in
+    every translated language, as pairs of the English color and of the
+    colors by country.
+    '''
+    web_translations = json.loads(open('colors.translations.json', 'r').read())
+    simple = lambda color: not any(s in color for s in ["-", "/", ",", ".", " e ", " and ", " oder ", " und ", " et "])
+    by_english = {c: {t: color for (color, t) in sorted(web_translations[c].items()) if simple(color)} for c in web_translations}
+    english = sorted(set.intersection(*[set(colors) for colors in by_english.values()]))
+    return [(t, {c: by_english[c][t] for c in by_english}) for t in english]
+
+def synthetic_inches(cm, generator):
+    '''
+    A length in inches written in one of the notations used by the
+    catalogs (integer, mixed number, fraction, decimal, or feet and inches).
+    '''
+    inches = Fraction(round(cm / 2.54 * 8), 8)
+    (whole, part) = (int(inches), inches - int(inches))
+    if whole >= 60 and generator.random() < 0.5:
+        return str(whole // 12) + "'" + str(whole % 12) + '"'
+    if generator.random() < 0.2:
+        return str(round(float(inches), 1))
+    if part == 0:
+        return str(whole)
+    return (str(whole) + " " if whole > 0 else "") + str(part.numerator) + "/" + str(part.denominator)
+
+def synthetic_dimensions(product, country, generator):
+    '''
+    The dimension columns (and unit) of a product in a catalog of the
+    given country, with the dimension labels of the configuration.
+    '''
+    LABELS = data.CONFIG['translations']['dimension_labels']
+    if country in {'us', 'ca'}:
+        (unit, length) = ("in", lambda cm: synthetic_inches(cm, generator))
+    elif generator.random() < 0.05:
+        (unit, length) = ("mm", lambda cm: str(int(round(cm * 10))))
+    else:
+        (unit, length) = ("cm", lambda cm: str(int(cm)) if cm == int(cm) else str(cm))
+    labelled = [generator.choice(LABELS[dim]) + length(cm) for (dim, cm) in product['dimensions']]
+    layout = generator.random()
+    if product['sizes'] > 1:
+        (dim, cm) = product['dimensions'][0]
+        dims = [generator.choice(LABELS[dim]) + "/".join(length(cm + 20 * i) for i in range(product['sizes']))] + labelled[1:]
+    elif layout < 0.4:
+        dims = labelled
+    elif layout < 0.7:
+        dims = [" x ".join(labelled)]
+    elif layout < 0.9:
+        dims = ["x".join(length(cm) for (dim, cm) in product['dimensions'])]
+    else:
+        dims = ["n/a"]
+    return (dims + [None, None, None])[:3] + [unit]
+
+def synthetic_quantity(generator):
+    PULS = data.CONFIG['translations']['product_unit_labels']
+    kind = generator.choice(["none", "none", "none", "number", "pieces", "pairs", "grams", "piece", "two", "six", "collection", "linear_meters", "square_feet"])
+    if kind == "none":
+        return None
+    if kind == "number":
+        return generator.randint(0, 6)
+    if kind in {"pieces", "pairs", "grams"}:
+        return str(generator.randint(2, 500 if kind == "grams" else 12)) + " " + generator.choice(PULS[kind])
+    return generator.choice(PULS[kind])
+
+def synthetic_products(count, generator):
+    '''
+    Products (belonging to fewer names, a few of them much more common than
+    the others) with an Ikea ID, dimensions in centimeters, a color, and
+    a price in dollars.
+    '''
+    colors = synthetic_colors()
+    names = sorted({"".join(generator.choice(SYNTHETIC_SYLLABLES) for _ in range(generator.randint(2, 3))) for _ in range(max(5, count // 4))})
+    weights = [1 / (rank + 1) for rank in range(len(names))]
+    products = []
+    for i in range(count):
+        scale = generator.uniform(5, 200)
+        dimensions = [(dim, round(scale * generator.uniform(0.3, 1.5), generator.choice([0, 0, 1]))) for dim in generator.choice([["wid", "dep", "hgt"], ["wid", "len"], ["hgt"], ["dia"]])]
+        products.append({
+            'name': generator.choices(names, weights)[0],
+            'description': generator.choice(SYNTHETIC_KINDS),
+            'ikeaid': "%03d.%03d.%02d" % (i // 1000, i % 1000, generator.randint(0, 99)),
+            'dimensions': dimensions,
+            'sizes': generator.choice([1, 1, 1, 1, 2, 3]),
+            'color': generator.choice(colors),
+            'price': generator.uniform(1, 500),
+            'other': generator.choice([None, None, None, "diameter", "thickness"])
+        })
+    return products
+
+def synthetic_row(product, country, generator):
+    '''
+    The columns (in the order of the configuration) of a product in a
+    catalog of the given country.
+    '''
+    (english, colors) = product['color']
+    (dim1, dim2, dim3, unit) = synthetic_dimensions(product, country, generator)
+    row = {
+        'page': generator.randint(1, 400), 'new': generator.choice([0, 0, 0, 1]), 'name': product['name'], 'description': product['description'],
+        'price': round(product['price'] * SYNTHETIC_PRICES[country]) - 0.01, 'quantity': synthetic_quantity(generator),
+        'dim1': dim1, 'dim2': dim2, 'dim3': dim3, 'unit': unit, 'color': english if country in {'us', 'uk', 'ca'} else colors[country],
+        'ikeaid': product['ikeaid']
+    }
+    inch = unit == "in"
+    if product['other'] == "diameter":
+        (row['other-measurement-1'], row['other-unit-1']) = (round(product['dimensions'][0][1] / (2.54 if inch else 1)), "diameter in" if inch else "diameter cm")
+    if product['other'] == "thickness":
+        (row['other-measurement-1'], row['other-unit-1']) = (generator.choice([1, 2, 3]), "in" if inch else "cm")
+        row['comments'] = generator.choice(sorted(data.CONFIG['translations']['comments']['thickness']))
+    return [row.get(column) for column in data.CONFIG['columns']]
+
+def synthetic_catalog(directory, size, seed = 0, countries = None, years = None):
+    '''
+    Write a synthetic catalog of about size entries, as one workbook per
+    country and year (all configured ones unless others are specified),
+    named and laid out as the legacy data set files. Every year the same
+    products are listed in the catalogs of (nearly) every country, so that
+    the colors of many of them can be matched across countries. Returns the
+    number of entries written.
+    '''
+    countries = data.CONFIG['countries'] if countries is None else countries
+    years = data.CONFIG['years'] if years is None else years
+    import xlsxwriter
+    generator = random.Random(seed)
+    per_file = max(1, size // (len(countries) * len(years)))
+    products = synthetic_products(max(20, 3 * per_file), generator)
+    os.makedirs(directory, exist_ok = True)
+    count = 0
+    for year in years:
+        listed = generator.sample(products, min(len(products), per_file))
+        for country in countries:
+            xl_workbook = xlsxwriter.Workbook(os.path.join(directory, country + str(year) + ".xlsx"), {'constant_memory': True})
+            xl_sheet = xl_workbook.add_worksheet("catalog")
+            xl_sheet.write_row(0, 0, data.CONFIG['columns'])
+            rows = [synthetic_row(product, country, generator) for product in listed if generator.random() < 0.95]
+            for (i, row) in enumerate(rows):
+                for (j, value) in enumerate(row):
+                    if value is not None:
+                        xl_sheet.write(i + 1, j, value)
+            xl_workbook.close()
+            count += len(rows)
+    return count
+
+def workbook_rows_reference(xlsx_file):
+    '''
+    The rows of an XLSX workbook after its header read cell by cell,
+    converting the cells of every type as xlrd cell types are converted
+    (error cells become None), and padded to the width of the header.
+    '''
+    import openpyxl
+    xl_workbook = openpyxl.load_workbook(xlsx_file, read_only = True, data_only = True)
+    rows = xl_workbook.worksheets[0].iter_rows()
+    width = len(next(rows))
+    values = []
+    for row in rows:
+        values.append([data.xlsx_number_to_json(c.value) if c.data_type == 'n' and type(c.value) in {int, float} else\
+                       data.xlsx_text_to_json(c.value) if c.data_type in {'s', 'inlineStr'} else None for c in row])
+        values[-1] += [None]*(width - len(values[-1]))
+    xl_workbook.close()
+    return values
+
+def benchmark_workbook_rows(size = 2000, repeat = 3, seed = 0):
+    '''
+    Check that ingesting the same synthetic catalog written as an XLS
+    workbook (read with xlrd) and as an XLSX workbook (streamed with
+    openpyxl) gives the same entries, with error and boolean cells among
+    the rows, and then compare the time of streaming the XLSX rows with
+    that of reading the cells one at a time.
+    '''
+    import openpyxl, xlwt
+    generator = random.Random(seed)
+    products = synthetic_products(max(20, size // 3), generator)
+    columns = data.CONFIG['columns']
+    rows = [synthetic_row(generator.choice(products), 'us', generator) for _ in range(size)]
+    for (i, row) in enumerate(rows):
+        if i % 7 == 0:
+            row[columns.index('price')] = '#N/A'
+        if i % 11 == 0:
+            row[columns.index('page')] = '#DIV/0!'
+        if i % 13 == 0:
+            row[columns.index('new')] = True
+    with tempfile.TemporaryDirectory() as directory:
+        (xls_dir, xlsx_dir) = (os.path.join(directory, "xls", ""), os.path.join(directory, "xlsx", ""))
+        (os.makedirs(xls_dir), os.makedirs(xlsx_dir))
+        xls_workbook = xlwt.Workbook()
+        xls_sheet = xls_workbook.add_sheet("catalog")
+        xlsx_workbook = openpyxl.Workbook(write_only = True)
+        xlsx_sheet = xlsx_workbook.create_sheet("catalog")
+        for (i, row) in enumerate([columns] + rows):
+            xlsx_sheet.append(row)
+            for (j, value) in enumerate(row):
+                if value in openpyxl.cell.cell.ERROR_CODES:
+                    xls_sheet.row(i).set_cell_error(j, {'#N/A': '#N/A!'}.get(value, value)) # As xlwt spells it.
+                elif value is not None:
+                    xls_sheet.write(i, j, value)
+        xls_workbook.save(xls_dir + "us2005.xls")
+        xlsx_workbook.save(xlsx_dir + "us2005.xlsx")
+
+        (_, expected, _) = data.xlsx_file_to_entries(xls_dir, 'us', 2005, columns)
+        (_, actual, _) = data.xlsx_file_to_entries(xlsx_dir, 'us', 2005, columns)
+        for (i, (e, a)) in enumerate(zip(expected, actual)):
+            if e != a:
+                raise AssertionError("Entry mismatch on row " + str(i + 1) + ": " + str(e) + " != " + str(a))
+        if len(expected) != len(actual):
+            raise AssertionError("Entry count mismatch: " + str(len(expected)) + " != " + str(len(actual)))
+        if workbook_rows_reference(xlsx_dir + "us2005.xlsx") != list(data.open_workbook_rows_try_extensions(xlsx_dir + "us2005"))[1:]:
+            raise AssertionError("Row mismatch between the streamed and the cell by cell XLSX rows.")
+        before = min(timeit.repeat(lambda: workbook_rows_reference(xlsx_dir + "us2005.xlsx"), number = 1, repeat = repeat))
+        after = min(timeit.repeat(lambda: list(data.open_workbook_rows_try_extensions(xlsx_dir + "us2005")), number = 1, repeat = repeat))
+    per_item = lambda seconds: 1000000 * seconds / size
+    return {'benchmark': 'workbook_rows', 'items': size, 'us_per_item': per_item(after), 'reference_us_per_item': per_item(before), 'speedup': before / after}
+
+def kmeans_fits(input_dir):
+    '''
+    Fit kmeans on every name of a partitioned data set using the number of
+    distinct Ikea ID as k (as kmeans.py does, without writing the results).
+    Returns the number of names fitted.
+    '''
+    import kmeans # Project-specific package (only needed for this benchmark).
+    fits = 0
+    for json_file in kmeans.listEntryFiles(input_dir):
+        k = kmeans.getIkeaIdCount(input_dir + json_file)
+        (entries, points) = kmeans.loadPoints(input_dir, json_file)
+        if 0 < k <= len(points):
+            kmeans.sweepKmeans(points, [k])
+            fits += 1
+    return fits
+
+def stage_profile(f):
+    '''
+    The time (in seconds) a stage takes and the peak memory (in bytes)
+    allocated while it runs, measured in a second run since tracing
+    allocations slows the stage down. The output of the stage is discarded.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        start = time.perf_counter()
+        f()
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        try:
+            f()
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return (seconds, peak)
+
+def benchmark_stages(sizes = (1000, 5000), seed = 0):
+    '''
+    Run every stage of the pipeline, from the ingestion of the workbooks to
+    the export of the grouped spreadsheet, on a synthetic catalog of each
+    size (in a temporary directory, which is also the working directory
+    of the stages).
+    '''
+    import kmeans # Project-specific package (only needed for this benchmark).
+    results = []
+    cwd = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = lambda name: os.path.join(directory, name)
+            count = synthetic_catalog(path("catalog"), size, seed)
+            shutil.copy('colors.translations.json', directory)
+            stages = [
+                ('ingest', lambda: data.xlsx_files_to_json_file(path("catalog") + os.sep, path("data.json"))),
+                ('projections_add', lambda: data.projections_add(path("data.json"), path("projected.json"))),
+                ('json_to_color_map', lambda: data.json_to_color_map(path("data.json"), path("colors.json"))),
+                ('derive_ad_hoc_groups', lambda: data.derive_ad_hoc_groups(path("projected.json"), path("grouped.json"))),
+                ('kmeans_partition', lambda: kmeans.groupByName(path("projected.json"), container = path("partitions"))),
+                ('kmeans_fit', lambda: kmeans_fits(path("partitions") + os.sep)),
+                ('xlsx_export', lambda: data.json_file_to_xlsx_file(path("grouped.json"), path("grouped.xlsx")))
+            ]
+            os.chdir(directory)
+            try:
+                for (stage, f) in stages:
+                    (seconds, peak) = stage_profile(f)
+                    results.append({'benchmark': 'stages', 'stage': stage, 'items': count, 'seconds': seconds,\
+                                    'us_per_item': 1000000 * seconds / max(1, count), 'peak_bytes': peak})
+            finally:
+                os.chdir(cwd)
+    return results
+
+BENCHMARKS = {
+    'dimension_scan': lambda args: benchmark_dimension_scan(dimension_strings(args.i) if args.i else SAMPLE_DIMENSIONS, args.repeat),
+    'unit_conversion': lambda args: benchmark_unit_conversion(dimension_strings(args.i) if args.i else SAMPLE_DIMENSIONS, args.repeat),
+    'projection': lambda args: benchmark_projection(list(entries_read(args.i)) if args.i else sample_entries(), args.repeat),
+    'grouping': lambda args: benchmark_grouping(list(entries_read(args.i)) if args.i else grouping_entries(), args.repeat),
+    'export': lambda args: benchmark_export(args.i, args.repeat),
+    'kmeans_sweep': lambda args: benchmark_kmeans_sweep(sweep_points(list(entries_read(args.i)) if args.i else None), repeat = args.repeat),
+    'stages': lambda args: benchmark_stages(args.sizes),
+    'startup': lambda args: benchmark_startup(args.i, args.repeat),
+    'color_map': lambda args: benchmark_color_map(args.i, args.repeat),
+    'workbook_rows': lambda args: benchmark_workbook_rows(repeat = args.repeat)
+}
+
+def result_key(result):
+    '''
+    The key under which a result is compared with a saved one (benchmarks
+    with several results, such as the stages, have one per stage and size).
+    '''
+    return "/".join([result['benchmark']] + ([result['stage'], str(result['items'])] if 'stage' in result else []))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs = "*", default = sorted(BENCHMARKS), help = "the benchmarks to run (all by default)")
+    parser.add_argument("-i", action = "store", help = "the data set file from which to take inputs")
+    parser.add_argument("-repeat", action = "store", type = int, default = 5, help = "the number of timing repetitions")
+    parser.add_argument("-save", action = "store", help = "the file to which to save the results")
+    parser.add_argument("-compare", action = "store", help = "a file of saved results with which to compare the results")
+    parser.add_argument("-sizes", nargs = "+", type = int, default = [1000, 5000], help = "the sizes of the synthetic catalogs of the stages benchmark")
+    parser.add_argument("-generate", action = "store", help = "only write a synthetic catalog (of the first size) into this directory")
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        print("Wrote " + str(synthetic_catalog(args.generate, args.sizes[0])) + " entries into '" + args.generate + "'.")
+        return
+
+    previous = {}
+    if args.compare is not None:
+        previous = {result_key(r): r for r in json.loads(open(args.compare).read())}
+    results = []
+    for name in args.benchmarks:
+        output = BENCHMARKS[name](args)
+        for result in (output if type(output) == list else [output]):
+            key = result_key(result)
+            if key in previous:
+                result['previous_us_per_item'] = previous[key]['us_per_item']
+                result['speedup_over_previous'] = previous[key]['us_per_item'] / result['us_per_item']
+            print(json.dumps(result))
+            results.append(result)
+    if args.save is not None:
+        open(args.save, 'w').write(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
+
+#eof
@@ -0,0 +1,193 @@
+###############################################################################
+##
+## cli.py
+##
+##   Command line entry point with a subcommand for every operation of
+##   data.py and kmeans.py, e.g.:
+##
+##     python cli.py ingest data/ data.json -workers 4
+##     python cli.py project data.json projected.json -incremental
+##     python cli.py partition projected.json -container partitions/
+##     python cli.py kmeans-ikeaid partitions/ results/ -summary summary.json
+##
+##   Every module (and through them scikit-learn, SciPy, matplotlib, and
+##   the configuration) is only loaded once the chosen subcommand runs, so
+##   the cheap subcommands start quickly. The global options are given
+##   before the subcommand.
+##
+##
+
+import argparse
+import os
+import sys
+
+###############################################################################
+##
+
+COMMANDS = {} # Subcommands by name, as (help, arguments, function) triples.
+
+def command(name, help, *arguments):
+    '''
+    Decorator registering a function taking the parsed arguments as the
+    subcommand with the given name and (name, options) arguments.
+    '''
+    def register(f):
+        COMMANDS[name] = (help, arguments, f)
+        return f
+    return register
+
+WORKERS = ("-workers", {'type': int, 'default': 1, 'help': "the number of processes (all cores if 0)"})
+
+def workers(args):
+    return None if args.workers == 0 else args.workers
+
+@command("ingest", "convert the legacy workbooks into a data set file",
+         ("xlsx_dir", {'help': "the directory holding the workbooks (one per country and year)"}),
+         ("json_file", {}),
+         ("-legible", {'action': "store_true", 'help': "indent the legacy JSON format"}),
+         ("-countries", {'nargs': "+", 'help': "only these countries (all configured ones by default)"}),
+         ("-years", {'nargs': "+", 'type': int, 'help': "only these years (all configured ones by default)"}),
+         ("-cache", {'help': "a directory caching the entries of unchanged workbooks"}),
+         WORKERS)
+def ingest(args):
+    import data # Project-specific package.
+    path = os.path.join(args.xlsx_dir, "")
+    data.xlsx_files_to_json_file(path, args.json_file, args.legible, args.countries, args.years, workers(args), args.cache)
+
+@command("jsonl", "convert a data set file in the legacy JSON format into JSON Lines",
+         ("json_file", {}), ("jsonl_file", {}))
+def jsonl(args):
+    from entries import json_file_to_jsonl_file # Project-specific package.
+    json_file_to_jsonl_file(args.json_file, args.jsonl_file)
+
+@command("colors", "build the color translation mapping of a data set",
+         ("input", {}), ("output", {}))
+def colors(args):
+    import data # Project-specific package.
+    data.json_to_color_map(args.input, args.output)
+
+@command("project", "project a data set onto normalized dimensions",
+         ("input", {}), ("output", {}),
+         ("-cache-size", {'type': int, 'default': 100000, 'help': "the size of the dimension cache (0 disables it)"}),
+         ("-cache-file", {'help': "a file keeping the dimension cache between runs"}),
+         ("-chunk-size", {'type': int, 'default': 1000, 'help': "the number of entries sent to a worker at once"}),
+         ("-incremental", {'action': "store_true", 'help': "only project new or changed entries"}),
+         WORKERS)
+def project(args):
+    import data # Project-specific package.
+    data.projections_add(args.input, args.output, args.cache_size, args.cache_file, workers(args), args.chunk_size, args.incremental)
+
+@command("group", "group a projected data set with the ad hoc clustering",
+         ("input", {}), ("output", {}),
+         ("-index", {'help': "a file keeping the cluster means and groups between runs"}),
+         ("-incremental", {'action': "store_true", 'help': "only merge the entries that are new since the indexed run"}))
+def group(args):
+    import data # Project-specific package.
+    data.derive_ad_hoc_groups(args.input, args.output, args.index, args.incremental)
+
+@command("xlsx", "export a data set as an XLSX spreadsheet",
+         ("json_file", {}), ("xlsx_file", {}),
+         ("-split", {'action': "store_true", 'help': "continue on further files (not sheets) past the row limit"}))
+def xlsx(args):
+    import data # Project-specific package.
+    data.json_file_to_xlsx_file(args.json_file, args.xlsx_file, args.split)
+
+@command("csv", "export a data set as a CSV file",
+         ("json_file", {}), ("csv_file", {}))
+def csv(args):
+    import data # Project-specific package.
+    data.json_file_to_csv_file(args.json_file, args.csv_file)
+
+@command("store", "export a projected data set as a columnar store",
+         ("json_file", {}), ("directory", {}))
+def store(args):
+    import data # Project-specific package.
+    data.json_file_to_store(args.json_file, args.directory)
+
+@command("partition", "divide a projected data set by name",
+         ("json_file", {}),
+         ("-container", {'help': "the container into which to write the partitions"}),
+         ("-directory", {'help': "a directory into which to also write one file per name"}),
+         ("-extension", {'default': ".json", 'help': "the extension of the files per name (.jsonl for JSON Lines)"}))
+def partition(args):
+    import kmeans # Project-specific package.
+    kmeans.groupByName(args.json_file, args.directory, args.extension, args.container)
+
+@command("summary", "summarize a projected data set by name",
+         ("json_file", {}), ("summary_file", {}))
+def summary(args):
+    import kmeans # Project-specific package.
+    kmeans.nameSummary(args.json_file, args.summary_file)
+
+@command("kmeans-ikeaid", "run kmeans on every name using its number of distinct Ikea ID as k",
+         ("input_dir", {'help': "a directory of files per name, or a container"}), ("output_dir", {}),
+         ("-summary", {'help': "a summary file from which to take the numbers of Ikea ID"}),
+         WORKERS)
+def kmeans_ikeaid(args):
+    import kmeans # Project-specific package.
+    kmeans.kmeansBasedOnIkeaIdCount(os.path.join(args.input_dir, ""), os.path.join(args.output_dir, ""), workers(args), args.summary)
+
+@command("kmeans-sweep", "run kmeans on every name for a range of k",
+         ("input_dir", {'help': "a directory of files per name, or a container"}), ("output_dir", {}),
+         ("low", {'type': int}), ("high", {'type': int}), ("increment", {'type': int}),
+         ("-writek", {'type': int, 'nargs': "*", 'default': [], 'help': "the k values for which to write the labelled results"}),
+         WORKERS)
+def kmeans_sweep(args):
+    import kmeans # Project-specific package.
+    if args.increment <= 0 or args.low <= 0 or args.low >= args.high:
+        sys.exit("The bounds should be positive, the higher bound larger than the lower one, and the increment positive.")
+    kmeans.iterkemansDirectory(os.path.join(args.input_dir, ""), os.path.join(args.output_dir, ""), args.low, args.high, args.increment, workers(args), args.writek)
+
+@command("kmeans-store", "run kmeans on every name of a columnar store, only recording the errors",
+         ("store_dir", {}), ("output_file", {}))
+def kmeans_store(args):
+    import kmeans # Project-specific package.
+    kmeans.kmeansStoreBasedOnIkeaIdCount(args.store_dir, args.output_file)
+
+@command("kmeans-compare", "compare the errors and times of full-batch and mini-batch kmeans",
+         ("input_dir", {'help': "a directory of files per name, or a container"}), ("report_file", {}),
+         ("-threshold", {'type': int, 'default': 0, 'help': "only compare names with more valid items"}))
+def kmeans_compare(args):
+    import kmeans # Project-specific package.
+    kmeans.compareKmeansModes(os.path.join(args.input_dir, ""), args.report_file, args.threshold)
+
+@command("pipeline", "run the stages from the workbooks to the grouped spreadsheet that are not up to date",
+         ("-source", {'default': "data/", 'help': "the directory holding the workbooks"}),
+         ("-directory", {'default': "", 'help': "the directory into which to write the outputs (the working directory by default)"}),
+         ("-parallel", {'type': int, 'default': 2, 'help': "the number of stages to run at once"}),
+         ("-incremental", {'action': "store_true", 'help': "project incrementally"}),
+         ("-force", {'action': "store_true", 'help': "run every stage, even if it is up to date"}),
+         ("-dry-run", {'action': "store_true", 'help': "only print the plan of the stages to run and to skip"}),
+         WORKERS)
+def pipeline(args):
+    import pipeline # Project-specific package.
+    stages = pipeline.pipeline_stages(args.source, args.directory, workers(args), args.incremental)
+    pipeline.pipeline_run(stages, pipeline.pipeline_state_file(args.directory), args.parallel, args.force, args.dry_run)
+
+def parser():
+    parser = argparse.ArgumentParser(description = "Operations on the IKEA catalog data sets.")
+    parser.add_argument("-config", help = "the configuration file (config.json in the working directory by default)")
+    parser.add_argument("-metrics", help = "the file to which to append a JSON metrics record for every stage (- for stderr)")
+    parser.add_argument("-profile", help = "the directory into which to write a cProfile profile of every stage (with -metrics)")
+    parser.add_argument("-tracemalloc", action = "store_true", default = None, help = "also trace the peak memory allocated by every stage (with -metrics)")
+    subparsers = parser.add_subparsers(dest = "command", metavar = "command", required = True)
+    for (name, (help, arguments, f)) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help = help, description = help)
+        for (argument, options) in arguments:
+            subparser.add_argument(argument, **options)
+        subparser.set_defaults(run = f)
+    return parser
+
+def main(argv = None):
+    args = parser().parse_args(argv)
+    if args.config is not None:
+        os.environ['IKEA_CONFIG'] = args.config # Also read by worker processes.
+    if args.metrics is not None:
+        from metrics import metrics_configure # Project-specific package.
+        metrics_configure(args.metrics, args.profile, args.tracemalloc)
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
+
+#eof
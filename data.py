@@ -9,19 +9,34 @@
 ##
 
 import argparse
+import glob
+import hashlib
+import importlib.util
 import json
+import math
+import os
+import pickle
 import xlrd
-import xlrd.sheet
-import xlsxwriter
 import re
-from collections import defaultdict
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice, repeat
 
+from entries import entries_read, entries_write # Project-specific package.
+from export import export_csv, export_store, export_xlsx # Project-specific package.
+from lazy import LazyConfig, LazyModule # Project-specific package.
 from measurements import Measurement, Assortment # Project-specific package.
+from metrics import metrics_count, metrics_counted, metrics_instrumented # Project-specific package.
+
+# Optional; used to stream XLSX files in read-only mode (and only imported then).
+openpyxl = LazyModule("openpyxl") if importlib.util.find_spec("openpyxl") is not None else None
 
 ###############################################################################
 ##
 
-CONFIG = json.loads(open('config.json').read()) # For conversion/translation.
+CONFIG = LazyConfig() # For conversion/translation (read from config.json when first used).
 
 def set_or_update_op(d, k, op, val):
     '''
@@ -35,21 +50,58 @@ def str_ascii_only(s):
     '''
     return s.encode("ascii", errors='ignore').decode("ascii").strip()
 
+def xlsx_number_to_json(value):
+    '''
+    Represent a numeric cell value as an integer where possible.
+    '''
+    return int(value) if abs(value - int(value)) < 0.0000000001 else float(value)
+
+def xlsx_text_to_json(value):
+    return str_ascii_only(str(value))
+
+# Converters from xlrd cell types and from openpyxl cell value types to
+# JSON values; cells of any other type (empty, dates, booleans, errors)
+# become None. As openpyxl yields the values of error cells as their codes
+# (e.g. '#N/A'), text equal to an error code becomes None as well.
+XLS_CELL_CONVERTERS = {xlrd.XL_CELL_NUMBER: xlsx_number_to_json, xlrd.XL_CELL_TEXT: xlsx_text_to_json}
+XLSX_VALUE_CONVERTERS = {int: xlsx_number_to_json, float: xlsx_number_to_json, str: xlsx_text_to_json}
+
 def xlsx_cell_to_json(column, cell):
     '''
     Use appropriate data structures and string representations
     based on the column/field and cell value.
     '''
-    cell_type = xlrd.sheet.ctype_text.get(cell.ctype, 'unknown type')
-    if cell_type == 'empty':
-        return None
-    elif cell_type == 'number' and abs(cell.value - int(cell.value)) < 0.0000000001:
-        return int(cell.value)
-    elif cell_type == 'number':
-        return float(cell.value)
-    elif cell_type == 'text':
-        return str_ascii_only(str(cell.value))
-    return None
+    converter = XLS_CELL_CONVERTERS.get(cell.ctype)
+    return None if converter is None else converter(cell.value)
+
+def xls_sheet_rows(xl_sheet):
+    '''
+    Yield the raw header row of an xlrd sheet followed by every other
+    row, converting each row to JSON values in bulk.
+    '''
+    yield xl_sheet.row_values(0)
+    for row_idx in range(1, xl_sheet.nrows):
+        yield [XLS_CELL_CONVERTERS[t](v) if t in XLS_CELL_CONVERTERS else None\
+               for (t, v) in zip(xl_sheet.row_types(row_idx), xl_sheet.row_values(row_idx))]
+
+def xlsx_sheet_rows(xl_workbook):
+    '''
+    Yield the raw header row of the first sheet of a read-only openpyxl
+    workbook followed by every other row, converting each row to JSON
+    values in bulk (and padding it to the width of the header).
+    '''
+    errors = frozenset(openpyxl.cell.cell.ERROR_CODES)
+    converters = dict(XLSX_VALUE_CONVERTERS)
+    converters[str] = lambda v: None if v in errors else xlsx_text_to_json(v)
+    try:
+        rows = xl_workbook.worksheets[0].iter_rows(values_only = True)
+        header = ['' if v is None else v for v in next(rows)]
+        yield header
+        for row in rows:
+            values = [converters[type(v)](v) if type(v) in converters else None for v in row]
+            yield values + [None]*(len(header) - len(values))
+    finally:
+        xl_workbook.close()
 
 def open_workbook_try_extensions(name):
     '''
@@ -64,96 +116,262 @@ def open_workbook_try_extensions(name):
             continue
     return xl_workbook
 
-def xlsx_to_dict(path, countries, years, columns, include_nulls = False):
+def open_workbook_rows_try_extensions(name):
+    '''
+    Attempt to open an Excel workbook file regardless of its extension,
+    returning an iterator over the rows of its first sheet (see
+    xls_sheet_rows and xlsx_sheet_rows). Files with an XLSX extension are
+    streamed in read-only mode if openpyxl is available.
+    '''
+    for ext in ["xlsx", "XLSX", "xls", "XLS"]:
+        try:
+            if openpyxl is not None and ext.lower() == "xlsx":
+                return xlsx_sheet_rows(openpyxl.load_workbook(name + "." + ext, read_only = True, data_only = True))
+            return xls_sheet_rows(xlrd.open_workbook(name + "." + ext).sheet_by_index(0))
+        except:
+            continue
+    return None
+
+def xlsx_file_to_entries(path, country, year, columns, include_nulls = False):
+    '''
+    Retrieves the entries from the XLSX file for a single (country, year)
+    pair. Returns the file path, the list of entries (or None if no file
+    was found), and the number of seconds spent on the file.
+    '''
+    start = time.time()
+    filepath = path + country + str(year)
+    rows = open_workbook_rows_try_extensions(filepath)
+    if rows is None:
+        return (filepath, None, time.time() - start)
+    first = next(rows).index('page')
+    entries = []
+    for values in rows:
+        entry = {'country': country, 'year': year} 
+        for (field, value) in zip(columns, values[first:first+len(columns)]):
+            if value is not None or include_nulls:
+                entry[field] = value
+        entries.append(entry)
+    return (filepath, entries, time.time() - start)
+
+def xlsx_file_cache_key(path, country, year, columns, include_nulls = False):
+    '''
+    Compute the cache key for the XLSX file of a (country, year) pair from
+    the column layout and the contents of every file that exists under one
+    of the candidate extensions (or None if there is no such file).
+    '''
+    filepath = path + country + str(year)
+    digest = hashlib.sha256(json.dumps([columns, include_nulls]).encode())
+    found = False
+    for ext in ["xlsx", "XLSX", "xls", "XLS"]:
+        if os.path.isfile(filepath + "." + ext):
+            found = True
+            digest.update(ext.encode())
+            with open(filepath + "." + ext, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest() if found else None
+
+def xlsx_file_cache_path(cache_dir, country, year, key):
+    return os.path.join(cache_dir, country + str(year) + "-" + key + ".pickle")
+
+def xlsx_files_changed(path, countries, years, columns, cache_dir, include_nulls = False):
+    '''
+    Determine which (country, year) XLSX files are new or have changed
+    since their entries were last cached. Returns the list of those pairs
+    together with a dictionary of the cache keys of all pairs.
+    '''
+    keys = {(c, y): xlsx_file_cache_key(path, c, y, columns, include_nulls) for c in countries for y in years}
+    changed = [(c, y) for c in countries for y in years\
+               if keys[(c, y)] is not None and not os.path.isfile(xlsx_file_cache_path(cache_dir, c, y, keys[(c, y)]))]
+    return (changed, keys)
+
+def xlsx_file_cache_store(cache_dir, country, year, key, entries):
+    '''
+    Cache the entries parsed from the XLSX file of a (country, year) pair,
+    replacing any entries cached for an earlier version of the file.
+    '''
+    os.makedirs(cache_dir, exist_ok = True)
+    for stale in glob.glob(os.path.join(glob.escape(cache_dir), country + str(year) + "-*.pickle")):
+        os.remove(stale)
+    cache_path = xlsx_file_cache_path(cache_dir, country, year, key)
+    with open(cache_path + ".tmp", 'wb') as handle:
+        pickle.dump(entries, handle, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + ".tmp", cache_path)
+
+def xlsx_to_dict(path, countries, years, columns, include_nulls = False, workers = 1, cache_dir = None):
     '''
     Converts data from multiple XLSX files into a single Python dictionary.
+    If workers is not 1, the files are parsed in a pool of that many processes
+    (all available cores if None); entries are always merged in country/year
+    order. If a cache directory is specified, only new or changed files are
+    parsed and the entries of all other files are loaded from the cache.
     '''
     entries = []
+    start = time.time()
     print("Retrieving data from files to build dictionary...")
-    for country in countries:
-        for year in years:
+    pairs = [(country, year) for country in countries for year in years]
+    (changed, keys) = xlsx_files_changed(path, countries, years, columns, cache_dir, include_nulls) if cache_dir is not None else (pairs, None)
+    tasks = (repeat(path), [c for (c, _) in changed], [y for (_, y) in changed], repeat(columns), repeat(include_nulls))
+    changed = set(changed)
+    with (ProcessPoolExecutor(max_workers = workers) if workers != 1 else nullcontext()) as executor:
+        results = map(xlsx_file_to_entries, *tasks) if executor is None else executor.map(xlsx_file_to_entries, *tasks)
+        for (country, year) in pairs:
             filepath = path + country + str(year)
-            xl_workbook = open_workbook_try_extensions(filepath)
-            if xl_workbook is None:
+            if (country, year) in changed:
+                (filepath, file_entries, seconds) = next(results)
+            elif keys[(country, year)] is not None:
+                with open(xlsx_file_cache_path(cache_dir, country, year, keys[(country, year)]), 'rb') as handle:
+                    entries.extend(pickle.load(handle))
+                print("...loaded cached data for unchanged file '" + filepath + "';")
+                continue
+            else:
+                file_entries = None
+            if file_entries is None:
                 print("...did not find any file '" + filepath + ".{xlsx/XLSX/xls/XLS} so skipping;")
                 continue
-            sheet_names = xl_workbook.sheet_names()
-            xl_sheet = xl_workbook.sheet_by_index(0)
-            row = xl_sheet.row(0)
-            cols = [cell_obj.value for idx, cell_obj in enumerate(row)]
-            first = cols.index('page')
-            for row_idx in range(1, xl_sheet.nrows):
-                entry = {'country': country, 'year': year} 
-                for (field, col_idx) in zip(columns, range(first, min(xl_sheet.ncols, first+len(columns)))):
-                    value = xlsx_cell_to_json(field, xl_sheet.cell(row_idx, col_idx))
-                    if value is not None or include_nulls:
-                        entry[field] = value
-                entries.append(entry)
-            print("...finished retrieving data from '" + filepath + "';")
-    print("...dictionary built successfully.")
+            if cache_dir is not None:
+                xlsx_file_cache_store(cache_dir, country, year, keys[(country, year)], file_entries)
+            entries.extend(file_entries)
+            print("...finished retrieving data from '" + filepath + "' (" + str(len(file_entries)) + " entries in " + "{:.2f}".format(seconds) + "s);")
+    print("...dictionary built successfully in " + "{:.2f}".format(time.time() - start) + "s.")
     return {'entries': entries}
 
-def xlsx_files_to_json_file(xlsx_files_path, json_file, legible = False, countries = CONFIG['countries'], years = CONFIG['years']):
+@metrics_instrumented("ingest")
+def xlsx_files_to_json_file(xlsx_files_path, json_file, legible = False, countries = None, years = None, workers = 1, cache_dir = None):
     '''
-    Saves data from XLSX files to a JSON file.
+    Saves data from XLSX files to a JSON file (for all countries and
+    years in the configuration unless others are specified).
     '''
-    d = xlsx_to_dict(xlsx_files_path, countries, years, CONFIG['columns'])
+    countries = CONFIG['countries'] if countries is None else countries
+    years = CONFIG['years'] if years is None else years
+    d = xlsx_to_dict(xlsx_files_path, countries, years, CONFIG['columns'], workers = workers, cache_dir = cache_dir)
+    metrics_count(len(d['entries']))
     print("Writing file '" + json_file + "'...")
-    with open(json_file, 'w') as handle:
-        if legible: handle.write(json.dumps(d, sort_keys = True, indent = 2)) # Human-legible.
-        else: handle.write(json.dumps(d))
+    entries_write(json_file, d['entries'], legible) # Human-legible if requested.
     print("...finished writing file '" + json_file + "'.\n")
 
-def json_file_to_xlsx_file(json_file, xlsx_file):
+@metrics_instrumented("xlsx_export")
+def json_file_to_xlsx_file(json_file, xlsx_file, split_files = False):
     '''
-    Converts a JSON file into an XLSX file.
+    Converts a JSON (or JSON Lines) file into an XLSX file (see export.py),
+    continuing on further sheets (or files) past the row limit of Excel.
     '''
     print("Converting data in file '" + json_file + "' to file '" + xlsx_file + "'...")
-    d = json.loads(open(json_file).read())
-    entries = d['entries']
+    count = export_xlsx(json_file, xlsx_file, CONFIG['dimensions'], split_files = split_files)
+    metrics_count(count)
+    print("...finished writing " + str(count) + " entries to file '" + xlsx_file + "'.\n")
 
-    xl_workbook = xlsxwriter.Workbook(xlsx_file)
-    xl_bold = xl_workbook.add_format({'bold': True})
-    xl_row_evn = xl_workbook.add_format({'bg_color':'#FFFFFF'})
-    xl_row_odd = xl_workbook.add_format({'bg_color':'#EAEAEA'})
-    xl_row_non = xl_workbook.add_format({'bg_color':'#FBFFD8'})
-    xl_sheet = xl_workbook.add_worksheet("data")
+@metrics_instrumented("csv_export")
+def json_file_to_csv_file(json_file, csv_file):
+    '''
+    Converts a JSON (or JSON Lines) file into a CSV file.
+    '''
+    print("Converting data in file '" + json_file + "' to file '" + csv_file + "'...")
+    count = export_csv(json_file, csv_file, CONFIG['dimensions'])
+    metrics_count(count)
+    print("...finished writing " + str(count) + " entries to file '" + csv_file + "'.\n")
 
-    groups = set()
-    for e in entries:
-        if 'group' in e and e['group'] is not None:
-            groups.add(e['group'])
-    group_to_index = {g:i for (g, i) in zip(sorted(list(groups)), range(0,len(groups)))}
+@metrics_instrumented("store_export")
+def json_file_to_store(json_file, directory):
+    '''
+    Converts a JSON (or JSON Lines) file of projected entries into a
+    columnar store (see store.py) holding every numeric dimension.
+    '''
+    print("Converting data in file '" + json_file + "' to store '" + directory + "'...")
+    count = export_store(json_file, directory, CONFIG['dimensions'])
+    metrics_count(count)
+    print("...finished writing " + str(count) + " entries to store '" + directory + "'.\n")
 
-    # Set the column widths.
-    for (i,w) in zip(range(0,11), [2,5,10,25,18,8,4,4.5,5.5,6.5,8]):
-        xl_sheet.set_column(i, i, w)
+def compile_numerical(patterns):
+    '''
+    Compile the notation patterns (such as CONFIG['numerical'])
+    for use by project_geometry_dimension_scan.
+    '''
+    return [(notation, re.compile(regexp)) for [notation, regexp] in patterns]
 
-    # Add the column headers.
-    for i in range(0,len(CONFIG['dimensions'])):
-        xl_sheet.write(0, i, CONFIG['dimensions'][i], xl_bold)
+class Corrections():
+    '''
+    Class for applying a list of [typo, fix] replacements in order. A
+    single combined pattern first checks whether any typo occurs at all,
+    so strings that need no corrections are only scanned once.
+    '''
+    def __init__(self, corrections):
+        self.corrections = [(typo, fix) for [typo, fix] in corrections]
+        typos = [typo for (typo, fix) in self.corrections]
+        self.pattern = re.compile("|".join(map(re.escape, typos))) if "" not in typos else None
+
+    def apply(self, text):
+        if self.pattern is not None and self.pattern.search(text) is None:
+            return text
+        for (typo, fix) in self.corrections:
+            text = text.replace(typo, fix)
+        return text
+
+    def applied(self, text):
+        '''
+        The [typo, fix] replacements that change the text (in order) when
+        the corrections are applied to it.
+        '''
+        if self.pattern is not None and self.pattern.search(text) is None:
+            return []
+        applied = []
+        for (typo, fix) in self.corrections:
+            if typo in text:
+                applied.append([typo, fix])
+                text = text.replace(typo, fix)
+        return applied
+
+class ProjectionRules():
+    '''
+    The rules used by the projection functions, compiled once from the
+    configuration when they are first used: hashed label sets, precompiled
+    regular expressions, and combined corrections. The fingerprint is a
+    digest of every part of the configuration used by the projection other
+    than the corrections (which are fingerprinted for each entry separately);
+    the dimension fingerprint also covers the dimension and unit corrections,
+    so it changes with any rule used by projection_geometry_dimension_values.
+    '''
+    def __init__(self, config):
+        self.config = config
 
-    # Insert the data (all rows).
-    for i in range(len(entries)):
-        entry = entries[i]
+    def __getattr__(self, name):
+        # Only called for the rules that are not compiled yet.
+        if name == 'config':
+            raise AttributeError(name)
+        self.compile()
+        return object.__getattribute__(self, name)
 
-        fmt = xl_row_non
-        if 'group' in entry and entry['group'] is not None:
-            fmt = xl_row_evn if ((group_to_index[entry['group']])%2==0) else xl_row_odd
+    def compile(self):
+        config = self.config
 
-        for j in range(0,len(CONFIG['dimensions'])):
-            dimension = CONFIG['dimensions'][j]
-            xl_sheet.write(i+1, j, entry.get(dimension), fmt)
+        # Lookup table for translating dimension labels.
+        self.dimension_labels = {TXT:DIM for (DIM, LBLS) in config['translations']['dimension_labels'].items() for TXT in LBLS}
+        self.thickness_comments = frozenset(config['translations']['comments']['thickness'])
 
-        # Progress counter.
-        if i > 0 and i % 5000 == 0:
-            print("...wrote " + str(i) + "/" + str(len(entries)) + " entries;")
+        # Product unit label sets and the pattern for numeric quantities.
+        self.product_unit_labels = {LBL:frozenset(TXTS) for (LBL, TXTS) in config['translations']['product_unit_labels'].items()}
+        self.product_unit_labels['piece_or_pieces'] = self.product_unit_labels['piece'] | self.product_unit_labels['pieces']
+        self.quantity_numerals = re.compile(r'(\s*)[0-9]+(\s*)')
 
-    xl_workbook.close()
-    print("...finished writing file '" + xlsx_file + "'.\n")
+        # Numeric notations, for matching numbers and for stripping them
+        # (along with the separators between them) from dimension labels.
+        self.numerical = compile_numerical(config['numerical'])
+        self.numerical_labels = [re.compile(r'(\s*)' + regexp + r'(\s*)') for [notation, regexp] in config['numerical']]
+        self.label_separators = str.maketrans('', '', '-x/+')
+
+        self.dimension_corrections = Corrections(config['corrections']['dimension'])
+        self.unit_corrections = Corrections(config['corrections']['unit'])
+        self.columns = config['columns']
+
+        parts = [config['numerical'], config['translations'], config['columns']]
+        self.fingerprint = hashlib.sha256(json.dumps(parts, sort_keys = True).encode()).hexdigest()
+        parts = [self.fingerprint, config['corrections']['dimension'], config['corrections']['unit']]
+        self.dimension_fingerprint = hashlib.sha256(json.dumps(parts, sort_keys = True).encode()).hexdigest()
+
+RULES = ProjectionRules(CONFIG)
 
 def projection_product_unit_quantity(entry):
-    PULS = CONFIG['translations']['product_unit_labels']
+    PULS = RULES.product_unit_labels
     quantity = entry.get("quantity")
     if quantity is None:
         return
@@ -164,13 +382,13 @@ def projection_product_unit_quantity(entry):
         return
 
     # Obtain any labels and numeric literals found in the quantity string.
-    label = re.sub(r'(\s*)[0-9]+(\s*)', '', quantity) # Quantity label (ignoring numeric quantity).
-    numerals = re.search(r'(\s*)[0-9]+(\s*)', quantity) # Numeric quantity, if present.
+    label = RULES.quantity_numerals.sub('', quantity) # Quantity label (ignoring numeric quantity).
+    numerals = RULES.quantity_numerals.search(quantity) # Numeric quantity, if present.
 
     if numerals:
         if quantity == str(int(numerals.group())): entry["pieces"] = int(numerals.group())
         elif quantity == "m2": entry["sqr_m"] = 1
-        elif label in (PULS['piece'] + PULS['pieces']): entry["pieces"] = int(numerals.group())
+        elif label in PULS['piece_or_pieces']: entry["pieces"] = int(numerals.group())
         elif label in PULS['pairs']: entry["pieces"] = 2*int(numerals.group())
         elif label in PULS['grams']: entry["grams"] = int(numerals.group())
         elif label in PULS['linear_meters']: entry["lin_m"] = int(numerals.group())
@@ -191,7 +409,8 @@ def project_geometry_dimension_matches(patterns, dimension):
     '''
     Retrieve all numeric values from a string that
     match one of the specified formats. Finds each
-    longest match from left to right.
+    longest match from left to right. (This is the
+    reference for project_geometry_dimension_scan.)
     '''
     suffix = dimension
     assortment = Assortment()
@@ -216,6 +435,37 @@ def project_geometry_dimension_matches(patterns, dimension):
 
     return assortment
 
+def project_geometry_dimension_scan(compiled, dimension):
+    '''
+    Retrieve all numeric values from a string that match one of the
+    specified compiled formats, finding exactly the same longest matches
+    from left to right as project_geometry_dimension_matches. The string is
+    never sliced: the next match of every pattern is remembered and only
+    searched for again once the scan has moved past its start, so each
+    pattern moves through the string once.
+    '''
+    assortment = Assortment()
+    position = 0
+    upcoming = [regexp.search(dimension) for (notation, regexp) in compiled]
+    while True:
+        # Find the longest upcoming match.
+        match = None
+        length = 0
+        for i in range(len(compiled)):
+            result = upcoming[i]
+            if result is not None and result.start() < position:
+                result = upcoming[i] = compiled[i][1].search(dimension, position)
+            if result is not None:
+                raw = result.group()
+                raw = raw[:-1] if raw[-1] in "-x+/" else raw
+                if len(raw) > length:
+                    length = len(raw)
+                    match = (raw, compiled[i][0], result.end())
+        if match is None:
+            return assortment
+        assortment.append(match[0], match[1])
+        position = match[2]
+
 def projection_geometry_dimension_normalize(country, dimension):
     '''
     Fix typos and normalize formatting for dimension column value.
@@ -225,8 +475,7 @@ def projection_geometry_dimension_normalize(country, dimension):
     if type(dimension) == int or type(dimension) == float:
         dimension = str(dimension)
     if type(dimension) == str:
-        for [typo, fix] in CONFIG['corrections']['dimension']:
-            dimension = dimension.replace(typo, fix)
+        dimension = RULES.dimension_corrections.apply(dimension)
         dimension = dimension.lower().strip()
         dimension = dimension[:-1] if dimension[-1] == '.' else dimension
 
@@ -241,9 +490,9 @@ def projection_geometry_dimension_normalize(country, dimension):
     # Clear out all numeric information from the dimension string
     # (leaving only the label, if one is present).
     dim_label = dimension
-    for [notation, regexp] in CONFIG['numerical']:
-        dim_label = re.sub(r'(\s*)' + regexp + r'(\s*)', '', dim_label)
-    dim_label = dim_label.replace('-','').replace('x','').replace('/','').replace('+','')
+    for regexp in RULES.numerical_labels:
+        dim_label = regexp.sub('', dim_label)
+    dim_label = dim_label.translate(RULES.label_separators)
     dim_label = dim_label.strip().lower()
 
     return (dimension, dim_label)
@@ -258,83 +507,313 @@ def projection_geometry_dimension_unit_normalize(country, assortment, unit):
     if unit is None and country == 'us' and set(assortment.notations()).issubset({'mixed', 'frac'}): # Mixed numbers are used exclusively to represent inches.
         return "in"
     if unit is not None:
-        for [typo, fix] in CONFIG['corrections']['unit']:
-            unit = unit.replace(typo, fix)
+        unit = RULES.unit_corrections.apply(unit)
         unit = unit.lower().strip()
         unit = "in" if unit == "po" and country in {'ca', 'fr'} else unit
         unit = "m" if unit == "meter" else unit
         return unit
 
-def projection_geometry_dimension(dimension_column, unit_column, entry):
+def projection_geometry_dimension_values(country, dimension, unit):
     '''
-    Extract labelled dimension measurement information from a
-    given combination of a dimension column and a unit column.
+    Compute the labelled dimension measurement information for a given
+    dimension column value and unit column value. Returns a tuple with the
+    translated dimension label (or None) and the maximum and minimum
+    measurements in centimeters, or None if nothing could be computed.
     '''
-    # Build lookup table for translating dimension labels.
-    DIMS = {TXT:DIM for (DIM, LBLS) in CONFIG['translations']['dimension_labels'].items() for TXT in LBLS}
+    DIMS = RULES.dimension_labels
 
     # Retrieve the fixed/normalized dimension column value.
-    (dimension, dim_label) = projection_geometry_dimension_normalize(entry['country'], entry.get(dimension_column))
+    (dimension, dim_label) = projection_geometry_dimension_normalize(country, dimension)
     if dimension is None:
         return None
 
     # Retrieve the numeric and dimension information from the column.
-    assortment = project_geometry_dimension_matches(CONFIG['numerical'], dimension)
+    assortment = project_geometry_dimension_scan(RULES.numerical, dimension)
 
     # Obtain the unit column text and fix typos where possible/reasonable.
-    unit = projection_geometry_dimension_unit_normalize(entry['country'], assortment, entry.get(unit_column))
+    unit = projection_geometry_dimension_unit_normalize(country, assortment, unit)
 
-    # Convert quantity representation match into a standard unit
-    # (centimeters) and extend the entry with this new information.
+    # Convert quantity representation match into a standard unit (centimeters).
     if assortment.set_unit(unit) and assortment:
-        if dim_label in DIMS:
-            set_or_update_op(entry, DIMS[dim_label] + '_max_cm', max, assortment.max().cm)
-            set_or_update_op(entry, DIMS[dim_label] + '_min_cm', min, assortment.min().cm)
-        set_or_update_op(entry, 'max_cm', max, assortment.max().cm)
-        set_or_update_op(entry, 'min_cm', min, assortment.min().cm)
+        return (DIMS.get(dim_label), assortment.max_cm(), assortment.min_cm())
     else:
-        pass #print(dimension + " :: " + str(unit) + " :: " + str(dim_label) + " :: " + str(dim_label in DIMS) + ".")
+        return None #print(dimension + " :: " + str(unit) + " :: " + str(dim_label) + " :: " + str(dim_label in DIMS) + ".")
+
+def projection_cache_fingerprint():
+    '''
+    Digest of the rules that affect dimension projections (see
+    ProjectionRules); a saved ProjectionCache is only loaded if it was
+    saved under the same rules.
+    '''
+    return RULES.dimension_fingerprint
+
+class ProjectionCache():
+    '''
+    Bounded least-recently-used cache of the results of
+    projection_geometry_dimension_values, keyed on the country,
+    dimension string, and unit string, that keeps hit/miss statistics
+    and can be saved to and loaded from a file.
+    '''
+    def __init__(self, maxsize = 100000):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, country, dimension, unit):
+        # The projection of a number only depends on its string representation.
+        key = (country, dimension if dimension is None or type(dimension) == str else str(dimension), unit)
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+        self.misses += 1
+        result = self.results[key] = projection_geometry_dimension_values(*key)
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last = False)
+        return result
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.results), 'hit_rate': (self.hits / total) if total > 0 else 0.0}
 
-def projection_geometry(entry):
+    def load(self, path):
+        if os.path.isfile(path):
+            with open(path, 'rb') as handle:
+                (fingerprint, results) = pickle.load(handle)
+            if fingerprint == projection_cache_fingerprint():
+                self.results.update(results[-self.maxsize:])
+
+    def save(self, path):
+        with open(path + ".tmp", 'wb') as handle:
+            pickle.dump((projection_cache_fingerprint(), list(self.results.items())), handle, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+def projection_geometry_dimension(dimension_column, unit_column, entry, cache = None):
+    '''
+    Extract labelled dimension measurement information from a
+    given combination of a dimension column and a unit column
+    (using a ProjectionCache if one is specified).
+    '''
+    (country, dimension, unit) = (entry['country'], entry.get(dimension_column), entry.get(unit_column))
+    values = projection_geometry_dimension_values(country, dimension, unit) if cache is None else cache.get(country, dimension, unit)
+
+    # Extend the entry with the new information.
+    if values is not None:
+        (dim, max_cm, min_cm) = values
+        if dim is not None:
+            set_or_update_op(entry, dim + '_max_cm', max, max_cm)
+            set_or_update_op(entry, dim + '_min_cm', min, min_cm)
+        set_or_update_op(entry, 'max_cm', max, max_cm)
+        set_or_update_op(entry, 'min_cm', min, min_cm)
+
+def projection_geometry(entry, cache = None):
     # Process every "standard" dimension column.
     for dimension_column in ["dim" + str(i) for i in range(1,4)]:
-        projection_geometry_dimension(dimension_column, "unit", entry)
+        projection_geometry_dimension(dimension_column, "unit", entry, cache)
 
     # Process the "other measurement" columns for thickness or diameter.
     if entry.get("other-unit-1") in {"diameter cm", "diameter in"}:
         entry["other-measurement-1"] = str(entry.get("other-measurement-1")) + " diameter"
         entry["other-unit-1"] = entry.get("other-unit-1").replace("diameter ", "")
-        projection_geometry_dimension("other-measurement-1", "other-unit-1", entry)
-    if entry.get("comments") in CONFIG['translations']['comments']['thickness']:
+        projection_geometry_dimension("other-measurement-1", "other-unit-1", entry, cache)
+    if entry.get("comments") in RULES.thickness_comments:
         entry["other-measurement-1"] = str(entry.get("other-measurement-1")) + " thick"
-        projection_geometry_dimension("other-measurement-1", "other-unit-1", entry)
+        projection_geometry_dimension("other-measurement-1", "other-unit-1", entry, cache)
+
+def projection_add(entry, cache = None):
+    '''
+    Clean up a single entry and extend it with its projections.
+    '''
+    # Remove any entries that do not have any data.
+    for column in RULES.columns:
+        if entry.get(column) == "n/a": 
+            del entry[column]
 
-def projections_add(input, output):
+    # Adjust data representations and one-off errors.
+    if entry.get("quantity") == 0: entry["quantity"] = 1
+    if entry.get("new") is not None: entry["new"] = (entry["new"] > 0)
+    if entry.get("exceptions") == "no printed page number, keyed PDF page number": entry["exceptions"] = "PDF pg #"
+
+    # Perform projections.
+    projection_product_unit_quantity(entry)
+    projection_geometry(entry, cache)
+    return entry
+
+def projection_fingerprint(entry):
+    '''
+    Digest of an (unprojected) entry, of the corrections that apply to the
+    strings in it that the projection corrects, and of the rest of the
+    configuration used by the projection. Two entries with the same
+    fingerprint have the same projection, so changing a correction only
+    changes the fingerprints of the entries to which it applies.
+    '''
+    # Every string that may be corrected, including the variants of the
+    # "other measurement" columns built by projection_geometry.
+    measurement = str(entry.get("other-measurement-1"))
+    dimensions = [entry.get("dim" + str(i)) for i in range(1,4)]
+    dimensions = [str(d) for d in dimensions if d is not None]\
+               + [measurement + suffix for suffix in ["", " diameter", " thick", " diameter thick"]]
+    units = [entry.get("unit"), entry.get("other-unit-1")]
+    units = [u for u in units if type(u) == str] + [u.replace("diameter ", "") for u in units if type(u) == str]
+    applied = [RULES.dimension_corrections.applied(d) for d in dimensions] + [RULES.unit_corrections.applied(u) for u in units]
+    parts = [entry, applied, RULES.fingerprint]
+    return hashlib.sha256(json.dumps(parts, sort_keys = True).encode()).hexdigest()
+
+def projection_fingerprints_path(output):
+    return output + ".fingerprints"
+
+def projections_previous(output):
+    '''
+    Load the entries of an earlier projection written to the output file
+    along with their fingerprints, as a dictionary from fingerprints to
+    projected entries (which is empty if there is no earlier projection
+    or its fingerprints do not match its entries).
+    '''
+    path = projection_fingerprints_path(output)
+    if not os.path.isfile(output) or not os.path.isfile(path):
+        return {}
+    fingerprints = open(path).read().split()
+    entries = list(entries_read(output))
+    if len(fingerprints) != len(entries):
+        print("...fingerprints in file '" + path + "' do not match the entries, ignoring them;")
+        return {}
+    return dict(zip(fingerprints, entries))
+
+def entries_chunks(entries, size):
+    '''
+    Split an iterable of entries into lists of (at most) the given size.
+    '''
+    iterator = iter(entries)
+    chunk = list(islice(iterator, size))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+def executor_map_ordered(executor, f, items, window):
+    '''
+    Apply a function to every item using an executor, yielding the results
+    in order while keeping at most window items in flight.
+    '''
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(f, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+PROJECTION_WORKER_CACHE = None # Dimension cache of a projection worker process.
+
+def projection_worker_init(cache_size, cache_file):
+    global PROJECTION_WORKER_CACHE
+    PROJECTION_WORKER_CACHE = ProjectionCache(cache_size) if cache_size > 0 else None
+    if PROJECTION_WORKER_CACHE is not None and cache_file is not None:
+        PROJECTION_WORKER_CACHE.load(cache_file)
+
+def projection_chunk(entries):
+    '''
+    Project a chunk of entries in a worker process, returning them along
+    with the number of hits and misses of the worker's dimension cache.
+    '''
+    cache = PROJECTION_WORKER_CACHE
+    (hits, misses) = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    entries = [projection_add(entry, cache) for entry in entries]
+    return (entries, cache.hits - hits, cache.misses - misses) if cache is not None else (entries, 0, 0)
+
+@metrics_instrumented("projections_add")
+def projections_add(input, output, cache_size = 100000, cache_file = None, workers = 1, chunk_size = 1000, incremental = False):
+    '''
+    Project every entry in the input file, streaming the entries from the
+    input file to the output file one at a time. Dimension projections are
+    memoized in a cache of the specified size (0 disables it), which is
+    loaded from and saved to the cache file if one is specified.
+
+    If workers is not 1, chunks of entries are projected in a pool of that
+    many processes (all available cores if None) and written in their
+    original order, so the output is identical. Every worker then has its
+    own cache, and the cache file is loaded but not updated.
+
+    If incremental is True, the fingerprint of every entry (see
+    projection_fingerprint) is written alongside the output file, and the
+    entries of an earlier projection written to the output file are
+    carried over for every entry whose fingerprint has not changed, so
+    only new or changed entries are projected. Changes to the projection
+    functions themselves are not fingerprinted, so a full projection is
+    needed after those.
+    '''
     print("Projecting data in file '" + input + "' to file '" + output + "'...")
-    d = json.loads(open(input, 'r').read())
-    entries = d['entries']
-    for i in range(len(entries)):
-        entry = entries[i]
-
-        # Remove any entries that do not have any data.
-        for column in CONFIG['columns']:
-            if entry.get(column) == "n/a": 
-                del entry[column]
-
-        # Adjust data representations and one-off errors.
-        if entry.get("quantity") == 0: entry["quantity"] = 1
-        if entry.get("new") is not None: entry["new"] = (entry["new"] > 0)
-        if entry.get("exceptions") == "no printed page number, keyed PDF page number": entry["exceptions"] = "PDF pg #"
-
-        # Perform projections.
-        projection_product_unit_quantity(entry)
-        projection_geometry(entry)
-
-        # Progress counter.
-        if i > 0 and i % 5000 == 0:
-            print("...processed " + str(i) + "/" + str(len(entries)) + " entries;")
-
-    open(output, 'w').write(json.dumps(d, sort_keys=True, indent=2)) # Human-legible.
+    cache = ProjectionCache(cache_size) if cache_size > 0 and workers == 1 else None
+    if cache is not None and cache_file is not None:
+        cache.load(cache_file)
+    stats = {'hits': 0, 'misses': 0}
+    previous = projections_previous(output) if incremental else {}
+    fingerprints = []
+
+    def fingerprinted(entries):
+        # Pair every entry with its earlier projection, if there is one.
+        for entry in entries:
+            if incremental:
+                fingerprints.append(projection_fingerprint(entry))
+                yield (entry, previous.get(fingerprints[-1]))
+            else:
+                yield (entry, None)
+
+    def projected():
+        for (i, (entry, reused)) in enumerate(fingerprinted(entries_read(input))):
+            yield projection_add(entry, cache) if reused is None else reused
+
+            # Progress counter.
+            if i > 0 and i % 5000 == 0:
+                print("...processed " + str(i) + " entries;")
+
+    def projected_parallel(executor):
+        # Only the entries without an earlier projection are sent to the
+        # workers; the chunks (with the earlier projections) are queued
+        # in the same order as the results.
+        chunks = deque()
+        def unprojected():
+            for chunk in entries_chunks(fingerprinted(entries_read(input)), chunk_size):
+                chunks.append(chunk)
+                yield [entry for (entry, reused) in chunk if reused is None]
+
+        count = 0
+        window = 2 * (workers if workers is not None else os.cpu_count())
+        for (results, hits, misses) in executor_map_ordered(executor, projection_chunk, unprojected(), window):
+            stats['hits'] += hits
+            stats['misses'] += misses
+            results = iter(results)
+            chunk = [next(results) if reused is None else reused for (entry, reused) in chunks.popleft()]
+            yield from chunk
+
+            # Progress counter.
+            if count // 5000 < (count + len(chunk)) // 5000:
+                print("...processed " + str(count + len(chunk)) + " entries;")
+            count += len(chunk)
+
+    if workers == 1:
+        entries_write(output, metrics_counted(projected())) # Human-legible.
+    else:
+        with ProcessPoolExecutor(max_workers = workers, initializer = projection_worker_init, initargs = (cache_size, cache_file)) as executor:
+            entries_write(output, metrics_counted(projected_parallel(executor))) # Human-legible.
+    if cache is not None:
+        stats = cache.stats()
+        if cache_file is not None:
+            cache.save(cache_file)
+    if stats['hits'] + stats['misses'] > 0:
+        hit_rate = stats['hits'] / (stats['hits'] + stats['misses'])
+        print("...dimension cache: " + str(stats['hits']) + " hits, " + str(stats['misses']) + " misses (" + "{:.1%}".format(hit_rate) + " hit rate);")
+
+    # Record the fingerprints of the entries (or remove those of an earlier
+    # incremental projection, which no longer match the output file).
+    path = projection_fingerprints_path(output)
+    if incremental:
+        reused = len([f for f in fingerprints if f in previous])
+        print("...reused " + str(reused) + " entries and recomputed " + str(len(fingerprints) - reused) + " entries;")
+        open(path + ".tmp", 'w').write("".join(f + "\n" for f in fingerprints))
+        os.replace(path + ".tmp", path)
+    elif os.path.isfile(path):
+        os.remove(path)
     print("...finished writing file '" + output + "'.\n")
 
 def color_normalize(color):
@@ -342,46 +821,59 @@ def color_normalize(color):
                 .replace('@', ' ')\
                 .lower().strip()
 
+class ColorNormalizer():
+    '''
+    Class for normalizing the colors of entries (restricted to ASCII, as
+    in the color ensembles), memoizing the normalized color of every
+    (country, raw color) pair as the same colors occur in thousands of
+    entries. The colors of the English catalogs have their separators
+    normalized and the color corrections applied, each as combined
+    Corrections (so colors without any are only scanned once).
+    '''
+    ENGLISH = frozenset(['us', 'uk', 'ca'])
+
+    def __init__(self, corrections):
+        self.separators = Corrections([[' and ', ' & '], [', in', ' in'], [', ', ' & '], ['/', ' & '], ['& &', '&'], ['-', ' ']])
+        self.corrections = Corrections(corrections)
+        self.normalized = {}
+
+    def normalize(self, country, color):
+        key = (country, color)
+        if key not in self.normalized:
+            if country in self.ENGLISH:
+                color = self.corrections.apply(self.separators.apply(color).strip())
+            self.normalized[key] = str_ascii_only(color_normalize(color))
+        return self.normalized[key]
+
+@metrics_instrumented("json_to_color_map")
 def json_to_color_map(input, output):
     '''
     Create a color translation mapping using only those entries
     that have ikeaid information and have color information
     corresponding to every country in the same year.
     '''
-    data = json.loads(open(input, 'r').read())
-
-    # Build mapping from ikeaid, year, and country to a color.
-    ikeaid_year_country_to_color = {}
-    for entry in data['entries']:
-        (ikeaid, year, country) = (entry.get('ikeaid'), str(entry.get('year')), entry.get('country'))
-        if ikeaid is not None and ikeaid != "n/a" and entry.get("color") != "n/a":
-            color = entry.get("color")
-            if country in {'us','uk','ca'}:
-                color = color\
-                  .replace(' and ', ' & ')\
-                  .replace(', in', ' in')\
-                  .replace(', ', ' & ')\
-                  .replace('/', ' & ')\
-                  .replace('& &', '&')\
-                  .replace('-', ' ')\
-                  .strip()
-                for (text, fix) in CONFIG['corrections']['colors']['en']:
-                    color = color.replace(text, fix)
-            color = color_normalize(color)
-            ikeaid_year_country_to_color.setdefault(ikeaid, {})
-            ikeaid_year_country_to_color[ikeaid].setdefault(year, {})
-            ikeaid_year_country_to_color[ikeaid][year].setdefault(country, [])
-            ikeaid_year_country_to_color[ikeaid][year][country].append(color)
+    # Build mapping from (ikeaid, year) pairs to the first color of every
+    # country (in the order in which the countries occur) in one pass.
+    normalizer = ColorNormalizer(CONFIG['corrections']['colors']['en'])
+    ikeaid_year_to_colors = {}
+    for entry in metrics_counted(entries_read(input)):
+        (ikeaid, color) = (entry.get('ikeaid'), entry.get("color"))
+        if ikeaid is not None and ikeaid != "n/a" and color != "n/a":
+            country = entry.get('country')
+            color = normalizer.normalize(country, color)
+            key = (ikeaid, str(entry.get('year')))
+            colors = ikeaid_year_to_colors.get(key)
+            if colors is None:
+                colors = ikeaid_year_to_colors[key] = {}
+            if country not in colors:
+                colors[country] = color
 
     # Build all ensembles of seven colors (one from each country)
     # for every (ikeaid, year) pair.
     ensembles = set()
-    for ikeaid in ikeaid_year_country_to_color:
-        for year in ikeaid_year_country_to_color[ikeaid]:
-            by_country = ikeaid_year_country_to_color[ikeaid][year]
-            if len(by_country) == 7:
-                if None not in [by_country[c][0] for c in by_country]:
-                    ensembles.add(tuple([(c, str_ascii_only(by_country[c][0])) for c in by_country]))
+    for by_country in ikeaid_year_to_colors.values():
+        if len(by_country) == 7:
+            ensembles.add(tuple(by_country.items()))
 
     # Build mapping from country and color to a set of corresponding
     # translations in English (avoiding conjunctions of phrases).
@@ -418,55 +910,238 @@ def json_to_color_map(input, output):
     raw = raw.replace(",\n        ", ", ").replace("[\n        ", "[").replace("\n      ]", "]")
     open(output, 'w').write(raw)
 
-def derive_ad_hoc_groups(input, output):
+def chebyshev_difference(x, y):
+    if type(x)==str and type(y)==str and x==y: return 0
+    if type(x) in {int,float} and type(y) in {int,float}: return abs(x-y)
+    return float("inf")
+
+def chebyshev(p, q):
+    '''
+    Chebyshev metric for vectors with heterogenous types.
+    '''
+    return max([chebyshev_difference(*v) for v in zip(p,q)])
+
+def chebyshev_closest(p, qs):
+    return sorted([(chebyshev(p, qs[i]), i) for i in range(len(qs))])[0]
+
+class CentroidIndex():
+    '''
+    Index of the (name, max_cm, min_cm) cluster means of a single name,
+    answering which mean (if any) is within the clustering radius of a
+    point. The means are bucketed in a grid of square cells as wide as the
+    radius on the (max_cm, min_cm) plane, so only the cells around a point
+    are searched. The result (the closest mean, ties going to the earliest
+    one) is the same as that of chebyshev_closest, which is used instead
+    for the rare points and means that cannot be placed on the grid.
+    '''
+    def __init__(self, radius = 3):
+        self.radius = radius
+        self.points = []
+        self.cells = {}
+        self.irregular = set() # Means that are not on the grid.
+
+    def regular(self, p):
+        return type(p[0]) == str and all(type(v) in {int,float} and math.isfinite(v) for v in p[1:])
+
+    def cell(self, x, y):
+        return (math.floor(x / self.radius), math.floor(y / self.radius))
+
+    def place(self, i):
+        p = self.points[i]
+        if self.regular(p):
+            self.cells.setdefault(self.cell(p[1], p[2]), set()).add(i)
+        else:
+            self.irregular.add(i)
+
+    def displace(self, i):
+        p = self.points[i]
+        if i in self.irregular:
+            self.irregular.remove(i)
+        else:
+            self.cells[self.cell(p[1], p[2])].remove(i)
+
+    def add(self, p):
+        self.points.append(p)
+        self.place(len(self.points) - 1)
+
+    def move(self, i, p):
+        self.displace(i)
+        self.points[i] = p
+        self.place(i)
+
+    def closest(self, p):
+        '''
+        The distance to and index of the mean closest to the point if it
+        is within the radius, or None otherwise.
+        '''
+        if len(self.points) == 0:
+            return None
+        if len(self.irregular) > 0 or not self.regular(p):
+            nearest = chebyshev_closest(p, self.points)
+        else:
+            # Any mean within the radius is in a cell between those of the
+            # corners of the square around the point.
+            (r, x, y) = (self.radius, p[1], p[2])
+            ((x0, y0), (x1, y1)) = (self.cell(x - r, y - r), self.cell(x + r, y + r))
+            nearest = None
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    for i in self.cells.get((cx, cy), ()):
+                        candidate = (chebyshev(p, self.points[i]), i)
+                        nearest = candidate if nearest is None or candidate < nearest else nearest
+        return nearest if nearest is not None and nearest[0] < self.radius else None
+
+def ad_hoc_label(p):
+    return "_".join([str(x) for x in p])
+
+def ad_hoc_merge(points, e):
+    '''
+    Merge an entry into the cluster means of its name: the closest mean
+    moves halfway towards the entry if it is close enough, and otherwise
+    the entry becomes a new mean. Returns the mean that moved (as it was
+    before it moved), or None.
+    '''
+    if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+        name = e.get('name')
+        p = (name, e['max_cm'], e['min_cm'])
+        index = points.setdefault(name, CentroidIndex())
+        nearest = index.closest(p)
+        if nearest is not None:
+            q = index.points[nearest[1]]
+            index.move(nearest[1], (p[0], (p[1]+q[1])/2, (p[2]+q[2])/2))
+            return q
+        index.add(p)
+    return None
+
+def ad_hoc_centroids(entries, points = None):
+    '''
+    Build (or extend) the index of cluster means of every name. This is
+    an ad hoc solution that has better performance and does not require
+    k up-front. An off-the-shelf k-means implementation would be ideal to use.
+    '''
+    points = {} if points is None else points
+    for e in entries:
+        ad_hoc_merge(points, e)
+    return points
+
+def ad_hoc_group(points, e):
+    '''
+    Populate an entry with the group of the cluster mean close to it, if
+    there is one.
+    '''
+    if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+        index = points[e.get('name')]
+        nearest = index.closest((e.get('name'), e['max_cm'], e['min_cm']))
+        if nearest is not None:
+            e['group'] = ad_hoc_label(index.points[nearest[1]])
+    return e
+
+AD_HOC_DIGEST_FIELDS = ['name', 'max_cm', 'min_cm'] # The only fields on which the group of an entry depends.
+
+def ad_hoc_entry_digest(e):
+    '''
+    The digest identifying an entry across incremental runs, computed from
+    the fields on which its group depends only (so that a change of any
+    other field, such as its price or color, does not make it look new).
+    '''
+    return hashlib.sha256(json.dumps([[f, e[f]] for f in AD_HOC_DIGEST_FIELDS if f in e]).encode()).hexdigest()
+
+def ad_hoc_index_save(index_file, points, groups):
+    '''
+    Save the cluster means of every name along with the group of every
+    grouped entry (keyed on the digest of the entry, with the number of
+    entries having that digest).
+    '''
+    index = {
+        'centroids': [[name, [[p[1], p[2]] for p in points[name].points]] for name in points],
+        'entries': groups
+    }
+    open(index_file + ".tmp", 'w').write(json.dumps(index))
+    os.replace(index_file + ".tmp", index_file)
+
+def ad_hoc_index_load(index_file):
+    '''
+    Load the cluster means and entry groups saved by ad_hoc_index_save.
+    '''
+    index = json.loads(open(index_file).read())
+    points = {}
+    for (name, means) in index['centroids']:
+        points[name] = CentroidIndex()
+        for (max_cm, min_cm) in means:
+            points[name].add((name, max_cm, min_cm))
+    return (points, index['entries'])
+
+@metrics_instrumented("derive_ad_hoc_groups")
+def derive_ad_hoc_groups(input, output, index_file = None, incremental = False):
     '''
     Populates the data set entries with a group index
     derived using an ad hoc clustering technique.
+
+    If an index file is specified, the cluster means and the group of
+    every entry are saved to it. If incremental is True, the index saved
+    by an earlier run is loaded instead of being rebuilt, and only the
+    entries that are new since that run are merged into it; an earlier
+    entry keeps its group unless the mean of that group moved. Entries
+    are matched with those of the earlier run on their name, max_cm, and
+    min_cm (see ad_hoc_entry_digest); if any entry of the earlier run is
+    no longer in the data set, the index is rebuilt from all the entries.
     '''
-    oo = float("inf") # Infinity.
-
-    # Chebyshev metric for vectors with heterogenous types.
-    def difference(x, y):
-        if type(x)==str and type(y)==str and x==y: return 0
-        if type(x) in {int,float} and type(y) in {int,float}: return abs(x-y)
-        return oo
-    def chebyshev(p, q):
-        return max([difference(*v) for v in zip(p,q)])
-    def closest(p, qs):
-        return sorted([(chebyshev(p, qs[i]), i) for i in range(len(qs))])[0]
-
-    d = json.loads(open(input, 'r').read())
-    entries = d['entries']
-
-    # Build the index of cluster means. This is an ad hoc solution
-    # that has better performance and does not require k up-front.
-    # An off-the-shelf k-means implementation would be ideal to use.
-    points = {}  
+    (points, groups) = ({}, {})
+    if incremental and index_file is not None and os.path.isfile(index_file):
+        (points, groups) = ad_hoc_index_load(index_file)
+
+    def classified(remaining):
+        # Pair every entry with its digest (only needed if there is an index
+        # file) and, for the entries grouped in the earlier run, with their
+        # group in that run (counting down the remaining earlier entries).
+        for e in entries_read(input):
+            digest = ad_hoc_entry_digest(e) if index_file is not None else None
+            earlier = remaining.get(digest, 0) > 0
+            if earlier:
+                remaining[digest] -= 1
+            yield (e, digest, earlier)
+
+    def merged(remaining):
+        (added, moved) = (0, set())
+        for (e, digest, earlier) in classified(remaining):
+            if not earlier:
+                q = ad_hoc_merge(points, e)
+                if q is not None:
+                    moved.add(ad_hoc_label(q))
+                added += 1
+        return (added, moved)
+
     print("Building index of cluster means.")
-    for e in entries:
-        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
-            name = e.get('name')
-            p = (name, e['max_cm'], e['min_cm'])
-            if not name in points:
-                points[name] = [p]
-            else:
-                (dist, i) = closest(p, points[name])
-                if dist < 3:
-                    q = points[name][i]
-                    points[name][i] = (p[0], (p[1]+q[1])/2, (p[2]+q[2])/2)
-                else:
-                    points[name].append(p)
+    remaining = {digest: count for (digest, (group, count)) in groups.items()}
+    (added, moved) = merged(remaining)
+    if any(count > 0 for count in remaining.values()):
+        # The means still include the entries that were removed (or changed).
+        print("...entries of the indexed run are no longer in the data set, rebuilding the index;")
+        points.clear()
+        groups.clear()
+        (added, moved) = merged({})
 
     # Populate the entries with their corresponding group indices.
     print("Populating entries with their corresponding group indices.")
-    for e in entries:
-        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
-            name = e.get('name')
-            (dist, i) = closest((name, e['max_cm'], e['min_cm']), points[name])
-            if dist < 3:
-                e['group'] = "_".join([str(x) for x in points[name][i]])
+    (updated, stats) = ({}, {'regrouped': 0})
+    def grouped():
+        for (e, digest, earlier) in classified({digest: count for (digest, (group, count)) in groups.items()}):
+            group = groups[digest][0] if earlier else None
+            if earlier and group not in moved:
+                if group is not None:
+                    e['group'] = group
+            else:
+                ad_hoc_group(points, e)
+                stats['regrouped'] += 1 if earlier else 0
+            if index_file is not None:
+                updated[digest] = [e.get('group'), updated[digest][1] + 1 if digest in updated else 1]
+            yield e
 
-    open(output, 'w').write(json.dumps(d, sort_keys=True, indent=2)) # Human-legible.
+    entries_write(output, metrics_counted(grouped())) # Human-legible.
+    if incremental:
+        print("...merged " + str(added) + " new entries (moving " + str(len(moved)) + " means) and regrouped " + str(stats['regrouped']) + " earlier entries.")
+    if index_file is not None:
+        ad_hoc_index_save(index_file, points, updated)
 
 def example():
     '''
@@ -474,15 +1149,19 @@ def example():
     It is assumed that the IKEA data sets are under the
     "data/" subdirectory path. This sequence converts the
     original data sets into the final spreadsheet of
-    projected and clustered results.
+    projected and clustered results (pipeline.py runs the
+    same sequence, skipping the stages that are up to date).
     '''
     xlsx_files_to_json_file('data/', 'data.json', True)
     #xlsx_files_to_json_file('data/', 'data.json', True, ['us'], [2005])
     json_to_color_map("data.json", "colors.json")
     projections_add("data.json", "projected.json")
+    #projections_add("data.json", "projected.json", incremental = True)
     #json_file_to_xlsx_file('projected.json', 'ikea-data.xlsx')
 
     derive_ad_hoc_groups('projected.json', 'grouped.json')
+    #derive_ad_hoc_groups('projected.json', 'grouped.json', 'grouped.index.json', incremental = True)
     json_file_to_xlsx_file('grouped.json', 'grouped.xlsx')
+    #json_file_to_store('projected.json', 'projected.store/')
 
 #eof
\ No newline at end of file
@@ -0,0 +1,97 @@
+###############################################################################
+##
+## entries.py
+##
+##   Functions for reading and writing data set entries in either the legacy
+##   JSON format (a single {"entries": [...]} document) or the JSON Lines
+##   format (one entry per line), so that stages can stream entries one at a
+##   time instead of holding the whole data set in memory.
+##
+##
+
+import json
+import os
+
+###############################################################################
+##
+
+def is_json_lines_file(path):
+    '''
+    Files with a ".jsonl" extension are written in the JSON Lines format.
+    '''
+    return path.endswith(".jsonl")
+
+def entries_read(path):
+    '''
+    Generate the entries stored in a file in either format. The format is
+    detected from the first line of the file: JSON Lines files are read
+    one line at a time, while legacy files must be loaded all at once.
+    '''
+    with open(path, 'r') as handle:
+        first = handle.readline()
+        if first == "":
+            return
+        try:
+            doc = json.loads(first)
+        except ValueError:
+            doc = None
+
+        # A legacy document written on a single line or across many lines.
+        if type(doc) == dict and list(doc.keys()) == ['entries']:
+            yield from doc['entries']
+            return
+        if doc is None:
+            yield from json.loads(first + handle.read())['entries']
+            return
+
+        yield doc
+        for line in handle:
+            if line.strip() != "":
+                yield json.loads(line)
+
+def entries_write(path, entries, legible = True):
+    '''
+    Write an iterable of entries to a file, consuming it one entry at a
+    time. Files with a ".jsonl" extension get one entry per line; for any
+    other file the legacy document is written exactly as json.dumps would
+    write {'entries': [...]} (sorted and indented if legible). Returns the
+    number of entries written. The entries are written into a temporary
+    file that only replaces the file once they are all written, so that an
+    interrupted run leaves no truncated file (and the entries can be read
+    from the file being replaced).
+    '''
+    count = 0
+    try:
+        with open(path + ".tmp", 'w') as handle:
+            if is_json_lines_file(path):
+                for entry in entries:
+                    handle.write(json.dumps(entry, sort_keys=True) + "\n")
+                    count += 1
+            elif legible:
+                handle.write('{\n  "entries": [')
+                for entry in entries:
+                    handle.write(("\n" if count == 0 else ",\n") + "    " + json.dumps(entry, sort_keys=True, indent=2).replace("\n", "\n    "))
+                    count += 1
+                handle.write("\n  ]\n}" if count > 0 else "]\n}")
+            else:
+                handle.write('{"entries": [')
+                for entry in entries:
+                    handle.write(("" if count == 0 else ", ") + json.dumps(entry))
+                    count += 1
+                handle.write(']}')
+    except BaseException:
+        if os.path.isfile(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+    os.replace(path + ".tmp", path)
+    return count
+
+def json_file_to_jsonl_file(json_file, jsonl_file):
+    '''
+    Convert a legacy JSON file into a JSON Lines file.
+    '''
+    print("Converting data in file '" + json_file + "' to file '" + jsonl_file + "'...")
+    count = entries_write(jsonl_file, entries_read(json_file))
+    print("...finished writing " + str(count) + " entries to file '" + jsonl_file + "'.\n")
+
+#eof
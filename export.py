@@ -0,0 +1,179 @@
+###############################################################################
+##
+## export.py
+##
+##   Exporters shared by the scripts for writing data set files as XLSX
+##   spreadsheets, CSV files, or columnar stores. Entries are streamed from the
+##   data set file and spreadsheets are written in constant-memory mode one
+##   row at a time, split across sheets (or files) at the row limit of Excel.
+##
+##
+
+import csv
+import os
+import threading
+import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
+
+from entries import entries_read # Project-specific package.
+from store import store_write # Project-specific package.
+
+###############################################################################
+##
+
+EXCEL_MAX_ROWS = 1048576 # Including the header row.
+XLSX_COLUMN_WIDTHS = [2,5,10,25,18,8,4,4.5,5.5,6.5,8]
+
+def xlsx_split_file_name(xlsx_file, part):
+    '''
+    The name of the file holding a given part (counting from 0) of a
+    spreadsheet split into several files.
+    '''
+    return xlsx_file if part == 0 else os.path.splitext(xlsx_file)[0] + "-" + str(part + 1) + ".xlsx"
+
+def entries_groups(entries):
+    '''
+    Scan entries for their number and the index (in sorted order) of
+    every group.
+    '''
+    groups = set()
+    count = 0
+    for e in entries:
+        count += 1
+        if 'group' in e and e['group'] is not None:
+            groups.add(e['group'])
+    return (count, {g:i for (i, g) in enumerate(sorted(groups))})
+
+def xlsx_workbook(xlsx_file):
+    xl_workbook = xlsxwriter.Workbook(xlsx_file, {'constant_memory': True})
+    formats = {
+        'bold': xl_workbook.add_format({'bold': True}),
+        'evn': xl_workbook.add_format({'bg_color':'#FFFFFF'}),
+        'odd': xl_workbook.add_format({'bg_color':'#EAEAEA'}),
+        'non': xl_workbook.add_format({'bg_color':'#FBFFD8'})
+    }
+    return (xl_workbook, formats)
+
+def xlsx_worksheet(xl_workbook, name, dimensions, xl_bold):
+    '''
+    Add a sheet with the column widths and the column headers.
+    '''
+    xl_sheet = xl_workbook.add_worksheet(name)
+    for (i,w) in enumerate(XLSX_COLUMN_WIDTHS):
+        xl_sheet.set_column(i, i, w)
+    xl_sheet.write_row(0, 0, dimensions, xl_bold)
+    return xl_sheet
+
+def export_xlsx(source, xlsx_file, dimensions, max_rows = EXCEL_MAX_ROWS, split_files = False):
+    '''
+    Write the entries of a data set file (or a list of entries already in
+    memory) as rows of the given dimensions, shading the rows of alternate
+    groups. Rows are streamed into workbooks in constant-memory mode; once
+    a sheet holds max_rows rows, the rows continue on a new sheet (or, if
+    split_files is True, in a new file, named by xlsx_split_file_name).
+    Returns the number of entries written.
+    '''
+    entries = (lambda: entries_read(source)) if type(source) == str else (lambda: source)
+    (count, group_to_index) = entries_groups(entries())
+    files = []
+    xl_workbook = None
+    xl_sheet = None
+    row = max_rows
+    sheets = 0
+    written = 0
+    for (i, entry) in enumerate(entries()):
+        # Start a new sheet (and, if necessary, a new workbook) at the row limit.
+        if row == max_rows:
+            if xl_workbook is None or split_files:
+                if xl_workbook is not None:
+                    xl_workbook.close()
+                files.append(xlsx_split_file_name(xlsx_file, len(files)))
+                (xl_workbook, formats) = xlsx_workbook(files[-1])
+                sheets = 0
+            sheets += 1
+            xl_sheet = xlsx_worksheet(xl_workbook, "data" if sheets == 1 else "data" + str(sheets), dimensions, formats['bold'])
+            row = 1
+
+        fmt = formats['non']
+        if 'group' in entry and entry['group'] is not None:
+            fmt = formats['evn'] if ((group_to_index[entry['group']])%2==0) else formats['odd']
+        xl_sheet.write_row(row, 0, [entry.get(dimension) for dimension in dimensions], fmt)
+        row += 1
+        written += 1
+
+        # Progress counter.
+        if i > 0 and i % 5000 == 0:
+            print("...wrote " + str(i) + "/" + str(count) + " entries;")
+
+    if xl_workbook is None:
+        files.append(xlsx_file)
+        (xl_workbook, formats) = xlsx_workbook(xlsx_file)
+        xlsx_worksheet(xl_workbook, "data", dimensions, formats['bold'])
+    xl_workbook.close()
+    return written
+
+def export_csv(json_file, csv_file, dimensions):
+    '''
+    Write the entries of a data set file as CSV rows of the given
+    dimensions (with a header row). Returns the number of entries written.
+    '''
+    count = 0
+    with open(csv_file, 'w', newline = '') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(dimensions)
+        for entry in entries_read(json_file):
+            writer.writerow(["" if entry.get(dimension) is None else entry.get(dimension) for dimension in dimensions])
+            count += 1
+    return count
+
+class ExportQueue():
+    '''
+    Bounded pool of threads running exports in the background. At most
+    max_pending exports are queued or running at once, and submitting
+    another blocks until one of them is done, so the results waiting to
+    be exported stay bounded in memory.
+    '''
+    def __init__(self, workers = 2, max_pending = 4):
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, f, *args):
+        self.slots.acquire()
+        future = self.executor.submit(f, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+
+        # Only keep the exports still running (or that failed).
+        self.futures = [p for p in self.futures if not p.done() or p.exception() is not None] + [future]
+        return future
+
+    def flush(self):
+        '''
+        Wait for every submitted export, raising the error of the first one
+        that failed.
+        '''
+        (futures, self.futures) = (self.futures, [])
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+def store_numeric(dimensions):
+    '''
+    The dimensions stored as numbers in a columnar store.
+    '''
+    return [d for d in dimensions if d in {'year', 'price', 'pieces', 'grams', 'lin_m', 'sqr_m', 'page'} or d.endswith('_cm')]
+
+def export_store(json_file, directory, dimensions):
+    '''
+    Write the entries of a data set file into a columnar store (see
+    store.py) holding every numeric dimension. Returns the number of
+    entries written.
+    '''
+    return store_write(entries_read(json_file), directory, store_numeric(dimensions))
+
+#eof
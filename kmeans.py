@@ -1,49 +1,181 @@
-from sklearn.cluster import KMeans
-from scipy.spatial.distance import cdist
-from pandas import Series, DataFrame
-import pandas as pd
 import numpy as np
-import xlrd
-import xlrd.sheet
-import xlsxwriter
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import savefig
-import argparse, os, json, cProfile
+import argparse, os, json, time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
-CONFIG = json.loads(open('config.json').read()) # For conversion/translation.
+try:
+    from threadpoolctl import threadpool_limits # Optional; used to limit BLAS threads in worker processes.
+except ImportError:
+    threadpool_limits = None
 
+from entries import entries_read, entries_write # Project-specific package.
+from export import ExportQueue, export_xlsx # Project-specific package.
+from lazy import LazyConfig, LazyModule # Project-specific package.
+from metrics import metrics_configure, metrics_count, metrics_counted, metrics_instrumented # Project-specific package.
+from partitions import Partitions, is_partitions, partition_file_name, partitions_write # Project-specific package.
+from store import Store # Project-specific package.
 
-def groupByName(json_file, out_directory):
+CONFIG = LazyConfig() # For conversion/translation (read from config.json when first used).
+
+def headlessBackend():
+    '''
+    plot with the non-interactive Agg backend unless another backend is chosen (e.g. with MPLBACKEND)
+    '''
+    if 'MPLBACKEND' not in os.environ:
+        import matplotlib
+        matplotlib.use("Agg")
+
+# scikit-learn, scipy, and matplotlib are only imported when kmeans is run or plotted
+cluster = LazyModule("sklearn.cluster")
+distance = LazyModule("scipy.spatial.distance")
+plt = LazyModule("matplotlib.pyplot", headlessBackend)
+
+
+@metrics_instrumented("kmeans_partition")
+def groupByName(json_file, out_directory = None, extension = ".json", container = None):
     '''
-    divide original data into subfiles by item name
+    divide original data by item name in one pass
+    the partitions are written into a single container (see partitions.py) if container is given,
+    and into one subfile per item name under out_directory if it is given
+    the subfiles are written in the JSON Lines format if extension is ".jsonl"
     '''
-    d = json.loads(open(json_file, 'r').read())
-    entries = d['entries']
-    itemname = []   # store the name of items
-    items={}    # dictionary, <itemname, itemlist>
+    items = {}    # dictionary, <itemname, itemlist>
     itemcount = {}
 
     print("divide ",json_file," by item name")
-    for e in entries:
-        if 'name'   in e:
-            name = e.get('name')
-            if name in itemname:  
-                tmp = items.get(name)
-            else:
-                itemname.append(name)
-                tmp = []
-            tmp.append(e)
-            items[name] = tmp
+    for e in metrics_counted(entries_read(json_file)):
+        if 'name' in e:
+            items.setdefault(e.get('name'), []).append(e)
+
+    if container != None:
+        partitions_write(items, container)
+        print("write ", container)
 
     for key,value in items.items():
-        dict = {'entries': value}
         itemcount[key.replace("/","_")] = len(value)
-        filename = out_directory + "/" + key.replace("/","_") + ".json"
-        writeJsonFiles(filename, dict)
+        if out_directory != None:
+            filename = out_directory + "/" + os.path.splitext(partition_file_name(key))[0] + extension
+            entries_write(filename, value)
+            print("write ", filename)
 
     # Sorted by count
     writeJsonFiles("name_count.json", sorted(itemcount.items(), key = lambda x: x[1], reverse = True))
 
+PARTITIONS = {} # Containers opened by readEntries and listEntryFiles, by directory.
+
+def openPartitions(directory):
+    if directory not in PARTITIONS:
+        PARTITIONS[directory] = Partitions(directory)
+    return PARTITIONS[directory]
+
+def readEntries(filepath):
+    '''
+    read the entries of a subfile, or of a partition if the directory of filepath is a container
+    '''
+    (directory, filename) = os.path.split(filepath)
+    if is_partitions(directory):
+        return openPartitions(directory).read_file(filename)
+    return list(entries_read(filepath))
+
+def streamEntries(filepath):
+    '''
+    generate the entries of a subfile (or of a partition of a container) one at a time
+    '''
+    (directory, filename) = os.path.split(filepath)
+    if is_partitions(directory):
+        return openPartitions(directory).stream_file(filename)
+    return entries_read(filepath)
+
+def listEntryFiles(input_dir):
+    '''
+    list the subfiles in input_dir, or the file names of the partitions if input_dir is a container
+    '''
+    if is_partitions(input_dir):
+        return openPartitions(input_dir).file_names()
+    return os.listdir(input_dir)
+
+
+def partitionSize(input_dir, json_file):
+    '''
+    the number of entries of a partition in a container, or the size of a subfile
+    only used to schedule the largest names first
+    '''
+    if is_partitions(input_dir):
+        return openPartitions(input_dir).count(openPartitions(input_dir).file_to_name[json_file])
+    return os.path.getsize(input_dir + json_file)
+
+THREAD_LIMITS = None # BLAS thread limits of a worker process.
+
+def limitThreads(threads):
+    '''
+    limit the BLAS/OpenMP threads of a worker process, so that workers do not oversubscribe the cores
+    '''
+    global THREAD_LIMITS
+    for variable in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[variable] = str(threads)
+    if threadpool_limits is not None:
+        THREAD_LIMITS = threadpool_limits(limits = threads)
+
+def initWorker(threads):
+    '''
+    initialize a worker process, which opens its own export queue
+    '''
+    global EXPORT_QUEUE
+    EXPORT_QUEUE = None
+    limitThreads(threads)
+
+def exportingTask(task, *arguments):
+    '''
+    run a task in a worker process, waiting for its background exports before returning its result
+    '''
+    with exportsInBackground():
+        return task(*arguments)
+
+def runPerName(task, input_dir, jsonFileList, arguments, workers = 1, perFile = None):
+    '''
+    run task(input_dir, json_file, *arguments) for every json file and return the results in the order of jsonFileList
+    if perFile is given, the arguments perFile[json_file] are appended for every json file
+    if workers is not 1, the files are scheduled across a pool of that many processes (all cores if None), largest first
+    '''
+    argumentsOf = lambda json_file: arguments + (tuple(perFile[json_file]) if perFile is not None else ())
+    if workers == 1:
+        return [task(input_dir, json_file, *argumentsOf(json_file)) for json_file in jsonFileList]
+
+    workers = workers if workers is not None else os.cpu_count()
+    threads = max(1, os.cpu_count() // workers)
+    order = sorted(range(len(jsonFileList)), key = lambda i: partitionSize(input_dir, jsonFileList[i]), reverse = True)
+    with ProcessPoolExecutor(max_workers = workers, initializer = initWorker, initargs = (threads,)) as executor:
+        futures = {i: executor.submit(exportingTask, task, input_dir, jsonFileList[i], *argumentsOf(jsonFileList[i])) for i in order}
+        return [futures[i].result() for i in range(len(jsonFileList))]
+
+EXPORT_QUEUE = None # Background export queue of this process, while one is open.
+EXPORT_WORKERS = 2 # Threads writing results in the background.
+EXPORT_PENDING = 4 # Results waiting to be written (or being written) at most.
+
+@contextmanager
+def exportsInBackground():
+    '''
+    open an export queue so that results are written in the background, and wait for all of them when done
+    '''
+    global EXPORT_QUEUE
+    if EXPORT_QUEUE is not None:
+        yield EXPORT_QUEUE
+        return
+    EXPORT_QUEUE = ExportQueue(EXPORT_WORKERS, EXPORT_PENDING)
+    try:
+        yield EXPORT_QUEUE
+    finally:
+        (queue, EXPORT_QUEUE) = (EXPORT_QUEUE, None)
+        queue.close()
+
+def exportResult(f, *arguments):
+    '''
+    run f(*arguments) in the background if an export queue is open, and right away otherwise
+    '''
+    if EXPORT_QUEUE is None:
+        f(*arguments)
+    else:
+        EXPORT_QUEUE.submit(f, *arguments)
 
 def writeJsonFiles(json_file, content):
     '''
@@ -62,16 +194,153 @@ def writeBlank(input_dir, json_file, output_dir):
     open(output_dir + json_file, 'w').write(json.dumps(content, sort_keys=True, indent=2))
     
 
-def runkmeans(input_dir, json_file, output_dir, cluster_number):
+MINIBATCH_THRESHOLD = 50000 # Files with more valid items than this are clustered with mini-batch kmeans.
+MIN_VALID_ITEM_BYTES = 32 # No valid item takes fewer bytes in a subfile (e.g. {"max_cm":1,"min_cm":1,"name":""}).
+
+def kmeansMode(input_dir, json_file):
+    '''
+    choose "full" or "minibatch" kmeans for json_file before loading it
+    the number of entries of a partition (or the size of a subfile) bounds its number of valid items, which are only counted in a streaming pass above the threshold
+    '''
+    bound = partitionSize(input_dir, json_file)
+    if not is_partitions(input_dir):
+        bound //= MIN_VALID_ITEM_BYTES
+    if bound <= MINIBATCH_THRESHOLD:
+        return "full"
+    validCount = 0
+    for e in streamEntries(input_dir + json_file):
+        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+            validCount += 1
+    return "minibatch" if validCount > MINIBATCH_THRESHOLD else "full"
+
+def streamPoints(input_dir, json_file, chunk_size = 10000):
+    '''
+    generate the (max_cm, min_cm) points of the valid items of json_file in chunks, reading the entries from disk one at a time
+    '''
+    chunk = []
+    for e in streamEntries(input_dir + json_file):
+        if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+            chunk.append([e.get('max_cm'), e.get('min_cm')])
+            if len(chunk) == chunk_size:
+                yield np.array(chunk, dtype = float)
+                chunk = []
+    if len(chunk) > 0:
+        yield np.array(chunk, dtype = float)
+
+def minibatchKmeans(input_dir, json_file, cluster_number, chunk_size = 10000, passes = 3):
+    '''
+    fit mini-batch kmeans on the points of json_file, consuming them in chunks from disk in every pass
+    returns the fitted model, or None if json_file has no valid items
+    '''
+    kmeans = cluster.MiniBatchKMeans(init = 'k-means++', n_clusters = cluster_number)
+    fitted = False
+    for _ in range(passes):
+        pending = np.zeros((0, 2))
+        for chunk in streamPoints(input_dir, json_file, chunk_size):
+            # The first batch must contain at least k points.
+            pending = np.vstack([pending, chunk])
+            if len(pending) >= cluster_number:
+                kmeans.partial_fit(pending)
+                pending = np.zeros((0, 2))
+                fitted = True
+        if len(pending) > 0:
+            kmeans.partial_fit(pending)
+            fitted = True
+    return kmeans if fitted else None
+
+def minibatchError(input_dir, json_file, centers, chunk_size = 10000):
+    '''
+    the error of the given centers over the points of json_file, consuming them in chunks from disk
+    '''
+    error = 0.0
+    for chunk in streamPoints(input_dir, json_file, chunk_size):
+        error += distance.cdist(chunk, centers, 'sqeuclidean').min(axis = 1).sum()
+    return error
+
+class SpilledEntries():
+    '''
+    the entries spilled as JSON lines into a file, iterated (as often as needed) in the order of the given offsets of their lines
+    '''
+    def __init__(self, spill_file, offsets):
+        self.spill_file = spill_file
+        self.offsets = offsets
+
+    def __iter__(self):
+        with open(self.spill_file) as handle:
+            for offset in self.offsets:
+                handle.seek(offset)
+                yield json.loads(handle.readline())
+
+def writeSpilledResultFiles(spill_file, offsets, outputfile):
+    writeResultFiles(SpilledEntries(spill_file, offsets), outputfile)
+    os.remove(spill_file)
+
+def writeStreamedKmeansResult(input_dir, json_file, centers, output_dir, cluster_number, chunk_size = 10000):
+    '''
+    label the valid items of json_file with the centers of their clusters, streaming its entries from disk in chunks,
+    and write them sorted by group into a JSON and an xlsx result file (as writeKmeansResult does) without holding them in memory:
+    the labelled entries are spilled into a file next to the result, from which they are read back in order
+    returns the error over all the valid items
+    '''
+    outputfile = resultFile(output_dir, json_file, cluster_number)
+    spill_file = outputfile + ".spill"
+    (groups, keys, offsets) = ({}, [], [])
+    error = 0.0
+    with open(spill_file, 'w') as spill:
+        def spillChunk(chunk):
+            '''
+            label the valid items of a chunk of entries, spill the chunk, and return its error
+            '''
+            valid = [e for e in chunk if 'name' in e and 'max_cm' in e and 'min_cm' in e]
+            error = 0.0
+            if len(valid) > 0:
+                distances = distance.cdist(np.array([[e.get('max_cm'), e.get('min_cm')] for e in valid], dtype = float), centers, 'sqeuclidean')
+                for (e, i) in zip(valid, distances.argmin(axis = 1)):
+                    if (e.get('name'), i) not in groups:
+                        groups[(e.get('name'), i)] = e.get('name') + "_" + str(centers[i][0]) + "_" + str(centers[i][1])
+                    e['group'] = groups[(e.get('name'), i)]
+                error = distances.min(axis = 1).sum()
+            for e in chunk:
+                keys.append(str(e.get('group', 0)))
+                offsets.append(spill.tell())
+                spill.write(json.dumps(e) + "\n")
+            return error
+
+        (chunk, validCount) = ([], 0)
+        for e in streamEntries(input_dir + json_file):
+            chunk.append(e)
+            if 'name' in e and 'max_cm' in e and 'min_cm' in e:
+                validCount += 1
+            if validCount == chunk_size:
+                error += spillChunk(chunk)
+                (chunk, validCount) = ([], 0)
+        error += spillChunk(chunk)
+
+    order = sorted(range(len(keys)), key = keys.__getitem__, reverse = True)
+    exportResult(writeSpilledResultFiles, spill_file, [offsets[i] for i in order], outputfile)
+    return error
+
+def runkmeans(input_dir, json_file, output_dir, cluster_number, mode = None):
     '''
     run kmeans on json_file
     k = cluster_number
+    mode is "full" for full-batch kmeans or "minibatch" for mini-batch kmeans consuming the entries in chunks from disk
+    by default, the mode is chosen by kmeansMode before the file is loaded
     '''
 
-    d = json.loads(open(input_dir+json_file, 'r').read())
-    entries = d['entries']
+    if mode is None:
+        mode = kmeansMode(input_dir, json_file)
+
+    if mode == "minibatch":
+        kmeans = minibatchKmeans(input_dir, json_file, cluster_number)
+        if kmeans is None:
+            writeBlank(input_dir, json_file, output_dir)
+            return
+        print("mini-batch kmeans on ", json_file)
+        return writeStreamedKmeansResult(input_dir, json_file, kmeans.cluster_centers_, output_dir, cluster_number)
+
+    entries = readEntries(input_dir+json_file)
 
-    name = []
     max_cm = []
     min_cm = []
     #print("Fetch max and min...")
@@ -80,7 +349,6 @@ def runkmeans(input_dir, json_file, output_dir, cluster_number):
     for e in entries:
     	if 'name' in e and 'max_cm' in e and 'min_cm' in e:
             validCount += 1
-            name.append(e.get('name'))
             max_cm.append(e.get('max_cm'))
             min_cm.append(e.get('min_cm'))
 
@@ -89,11 +357,8 @@ def runkmeans(input_dir, json_file, output_dir, cluster_number):
         writeBlank(input_dir, json_file, output_dir)
         return 
 
-    # store in a dataframe
-    frame = DataFrame({"name": name, "max_cm": max_cm, "min_cm": min_cm})
-
-    kmeans = KMeans(init = 'k-means++', n_clusters = cluster_number)
-    predictResult = kmeans.fit_predict(frame.ix[:,['max_cm','min_cm']])
+    kmeans = cluster.KMeans(init = 'k-means++', n_clusters = cluster_number)
+    predictResult = kmeans.fit_predict(np.column_stack((max_cm, min_cm)))
 
     '''
     for e in entries:
@@ -103,92 +368,102 @@ def runkmeans(input_dir, json_file, output_dir, cluster_number):
     		#print(e['group'])
     '''
 
+    writeKmeansResult(entries, kmeans.cluster_centers_, predictResult, output_dir, json_file, cluster_number)
+    return kmeans.inertia_
+
+def resultFile(output_dir, json_file, cluster_number):
+    (base, ext) = os.path.splitext(json_file)
+    return output_dir + base + "result"+"_"+str(cluster_number) + ext
+
+def writeKmeansResult(entries, centers, labels, output_dir, json_file, cluster_number):
+    '''
+    label the valid items of entries with the centers of their clusters, and write them sorted by group into a JSON and an xlsx result file
+    '''
     index = 0
     for i in range(len(entries)):
         if 'name' in entries[i] and 'max_cm' in entries[i] and 'min_cm' in entries[i]:
-            center = kmeans.cluster_centers_[predictResult[index]]
+            center = centers[labels[index]]
             entries[i]['group'] = entries[i].get('name') + "_" + str(center[0]) + "_" + str(center[1])
             index += 1
 
     entries.sort(key=lambda k: (str(k.get('group', 0))), reverse = True)
 
-    outputfile = output_dir + json_file.replace(".json", "result"+"_"+str(cluster_number)+".json")
-    writeJsonFiles(outputfile, d)
-    json_file_to_xlsx_file(outputfile, outputfile.replace(".json", ".xlsx"))
-    return kmeans.inertia_
-    
+    exportResult(writeResultFiles, entries, resultFile(output_dir, json_file, cluster_number))
 
-def json_file_to_xlsx_file(json_file, xlsx_file):
+def writeResultFiles(entries, outputfile):
     '''
-    Converts a JSON file into an XLSX file.
+    write labelled entries (a list, or SpilledEntries) into a JSON and an xlsx result file
     '''
-    print("Converting data in file '" + json_file + "' to file '" + xlsx_file + "'...")
-    d = json.loads(open(json_file).read())
-    entries = d['entries']
-
-    xl_workbook = xlsxwriter.Workbook(xlsx_file)
-    xl_bold = xl_workbook.add_format({'bold': True})
-    xl_row_evn = xl_workbook.add_format({'bg_color':'#FFFFFF'})
-    xl_row_odd = xl_workbook.add_format({'bg_color':'#EAEAEA'})
-    xl_row_non = xl_workbook.add_format({'bg_color':'#FBFFD8'})
-    xl_sheet = xl_workbook.add_worksheet("data")
-
-    groups = set()
-    for e in entries:
-        if 'group' in e and e['group'] is not None:
-            groups.add(e['group'])
-    group_to_index = {g:i for (g, i) in zip(sorted(list(groups)), range(0,len(groups)))}
-
-    # Set the column widths.
-    for (i,w) in zip(range(0,11), [2,5,10,25,18,8,4,4.5,5.5,6.5,8]):
-        xl_sheet.set_column(i, i, w)
-
-    # Add the column headers.
-    for i in range(0,len(CONFIG['dimensions'])):
-        xl_sheet.write(0, i, CONFIG['dimensions'][i], xl_bold)
-
-    # Insert the data (all rows).
-    for i in range(len(entries)):
-        entry = entries[i]
-
-        fmt = xl_row_non
-        if 'group' in entry and entry['group'] is not None:
-            fmt = xl_row_evn if ((group_to_index[entry['group']])%2==0) else xl_row_odd
-
-        for j in range(0,len(CONFIG['dimensions'])):
-            dimension = CONFIG['dimensions'][j]
-            xl_sheet.write(i+1, j, entry.get(dimension), fmt)
-
-        # Progress counter.
-        if i > 0 and i % 5000 == 0:
-            print("...wrote " + str(i) + "/" + str(len(entries)) + " entries;")
+    entries_write(outputfile, entries)
+    print("write ", outputfile)
+    xlsx_file = os.path.splitext(outputfile)[0] + ".xlsx"
+    export_xlsx(entries, xlsx_file, CONFIG['dimensions'])
+    print("write ", xlsx_file)
+    
 
-    xl_workbook.close()
-    print("...finished writing file '" + xlsx_file + "'.\n")
+def loadPoints(input_dir, json_file):
+    '''
+    read the entries of json_file once, and return them along with the (max_cm, min_cm) points of the valid items
+    '''
+    entries = readEntries(input_dir + json_file)
+    points = [[e.get('max_cm'), e.get('min_cm')] for e in entries if 'name' in e and 'max_cm' in e and 'min_cm' in e]
+    return (entries, np.array(points, dtype = float).reshape(-1, 2))
 
-def iterkmeansSingleFile(input_dir, json_file, output_dir, start_k, end_k, increment):
+def farthestPoints(points, centers, count):
+    '''
+    add count centers to the given ones, each time picking the point farthest from all the centers picked so far
+    '''
+    nearest = distance.cdist(points, centers).min(axis = 1)
+    for _ in range(count):
+        i = int(np.argmax(nearest))
+        centers = np.vstack([centers, points[i:i+1]])
+        nearest = np.minimum(nearest, distance.cdist(points, points[i:i+1])[:, 0])
+    return centers
+
+def sweepKmeans(points, ks, keep = ()):
+    '''
+    fit kmeans on the points for every k in ks (in increasing order), warm-starting each fit from the centroids of the previous k
+    returns a dictionary <k, error> (nan if there are fewer points than k) and a dictionary <k, kmeans> of the fits of the k values in keep
+    '''
+    errors = {}
+    fits = {}
+    centers = None
+    for k in sorted(ks):
+        if k > len(points):
+            errors[k] = float('nan')
+            continue
+        if centers is None:
+            kmeans = cluster.KMeans(init = 'k-means++', n_clusters = k)
+        else:
+            kmeans = cluster.KMeans(init = farthestPoints(points, centers, k - len(centers)), n_clusters = k, n_init = 1)
+        kmeans.fit(points)
+        centers = kmeans.cluster_centers_
+        errors[k] = kmeans.inertia_
+        if k in keep:
+            fits[k] = kmeans
+    return (errors, fits)
+
+def iterkmeansSingleFile(input_dir, json_file, output_dir, start_k, end_k, increment, write_k = ()):
     '''
     run kmeans for different k values
+    the points are loaded once and every k is warm-started from the previous one, only the errors are recorded
+    the labelled results are only written for the k values in write_k
     '''
     
     if(start_k > end_k):
         print("end_k must be larger than start_k")
         return 
 
-    error = np.zeros(int((end_k - start_k) / increment) + 1)
-    #error = np.zeros(end_k + 1)
-
-
-    k = start_k
-    while(k <= end_k):
-        error[int((k - start_k)/increment)] = runkmeans(input_dir, json_file, output_dir, k)
-        #error[k] = runkmeans(input_dir, json_file, output_dir, k)
-        k += increment
-    #error = [4234.82432459,3720.48656751,2947.39259877]
+    (entries, points) = loadPoints(input_dir, json_file)
+    if len(points) == 0:
+        writeBlank(input_dir, json_file, output_dir)
+        return
 
-    # get count
-    d = json.loads(open(input_dir + json_file).read())
-    entries = d['entries']
+    ks = list(range(start_k, end_k + 1, increment))
+    (errors, fits) = sweepKmeans(points, ks, set(write_k))
+    error = np.array([errors[k] for k in ks])
+    for k in sorted(fits):
+        writeKmeansResult([dict(e) for e in entries], fits[k].cluster_centers_, fits[k].labels_, output_dir, json_file, k)
 
     fig, ax = plt.subplots()
     plt.plot(error)
@@ -198,31 +473,60 @@ def iterkmeansSingleFile(input_dir, json_file, output_dir, start_k, end_k, incre
     #ax.set_xticklabels(labels)
     dummy = plt.ylabel('Error')
     #plt.show()
-    savefig("figures/" + json_file.split(".")[0] + "_" + str(len(entries)) + "_" + str(start_k) + "_" + str(end_k) + "_" + str(increment) + ".png")
+    plt.savefig("figures/" + json_file.split(".")[0] + "_" + str(len(entries)) + "_" + str(start_k) + "_" + str(end_k) + "_" + str(increment) + ".png")
+    plt.close(fig)
+    return errors
 
-def iterkemansDirectory(input_dir, output_dir, start_k, end_k, increment):
+@metrics_instrumented("kmeans_sweep")
+def iterkemansDirectory(input_dir, output_dir, start_k, end_k, increment, workers = 1, write_k = ()):
     '''
     run kmeans on all the json files in input_dir and output the result to output_dir
+    the files are processed by a pool of processes if workers is not 1
     '''
-    jsonFileList = os.listdir(input_dir)
-    for i in range(len(jsonFileList)):
-        iterkmeansSingleFile(input_dir, jsonFileList[i], output_dir, start_k, end_k, increment)
+    jsonFileList = listEntryFiles(input_dir)
+    metrics_count(len(jsonFileList), 'names')
+    with exportsInBackground():
+        runPerName(iterkmeansSingleFile, input_dir, jsonFileList, (output_dir, start_k, end_k, increment, write_k), workers)
 
 
-def kmeansBasedOnIkeaIdCount(input_dir, output_dir): 
+def kmeansIkeaIdCount(input_dir, json_file, output_dir, cluster_number = None, validCount = None):
+    '''
+    run kmeans on json_file using its count of Ikea ID as k, and return the count and the error (-1 if there is no Ikea ID)
+    the count is read from json_file unless it is given, and the mode of kmeans is chosen from the number of valid items if it is given
+    '''
+    if cluster_number is None:
+        cluster_number = getIkeaIdCount(input_dir + json_file)
+    mode = None if validCount is None else ("minibatch" if validCount > MINIBATCH_THRESHOLD else "full")
+    if cluster_number != 0:
+        error = runkmeans(input_dir, json_file, output_dir, cluster_number, mode)
+    else:
+        error = -1;
+    return (cluster_number, error)
+
+@metrics_instrumented("kmeans_ikeaid_count")
+def kmeansBasedOnIkeaIdCount(input_dir, output_dir, workers = 1, summary_file = None): 
     '''
     Use the count of Ikea ID of a jsonfile as the parameter k of its kmeans
+    the counts are taken from a summary index (see nameSummary) if summary_file is given, without reading the files (except those of names missing from it)
+    the files are processed by a pool of processes if workers is not 1, and the errors are gathered in the order of the files
     '''
     print("start kmeans")
-    jsonFileList = os.listdir(input_dir)
+    jsonFileList = listEntryFiles(input_dir)
+    metrics_count(len(jsonFileList), 'names')
+    perFile = None
+    if summary_file != None:
+        summary = json.loads(open(summary_file).read())
+        byFile = {os.path.splitext(partition_file_name(name))[0]: stats for (name, stats) in summary.items()}
+        stats = lambda f: byFile.get(os.path.splitext(f)[0])
+        # Names missing from a stale summary are counted from their files instead.
+        perFile = {f: (stats(f)['ikeaid_count'], stats(f)['valid']) if stats(f) is not None else (None, None) for f in jsonFileList}
+        missing = [f for f in jsonFileList if stats(f) is None]
+        if len(missing) > 0:
+            print("not in the summary ", summary_file, ", counting Ikea ID from the files: ", ", ".join(sorted(missing)))
     errordic = {}
-    for i in range(len(jsonFileList)):
-        filepath = input_dir + jsonFileList[i]
-        cluster_number = getIkeaIdCount(filepath)
-        if cluster_number != 0:
-            error = runkmeans(input_dir, jsonFileList[i], output_dir, cluster_number)
-        else:
-            error = -1;
+    with exportsInBackground():
+        results = runPerName(kmeansIkeaIdCount, input_dir, jsonFileList, (output_dir,), workers, perFile)
+    for (cluster_number, error) in results:
         if str(cluster_number) in errordic:
             tmp = errordic.get(str(cluster_number))
         else:
@@ -245,48 +549,149 @@ def kmeansBasedOnIkeaIdCount(input_dir, output_dir):
     
     plt.plot(errorarr[:100])
     plt.title("error when use ikeaid numbers as k")
-    savefig("error_ikeaidnumberkallk.png")
+    plt.savefig("error_ikeaidnumberkallk.png")
 
     plt.plot(errorarr[:100])
     plt.title("error when use ikeaid numbers as k")
-    savefig("error_ikeaidnumberklittlek.png")
+    plt.savefig("error_ikeaidnumberklittlek.png")
     
     
+@metrics_instrumented("kmeans_summary")
+def nameSummary(json_file, summary_file = None):
+    '''
+    build a summary index of every item name in one streaming pass over json_file (such as projected.json)
+    for every name it records the number of entries, the number of distinct Ikea ID and of valid items (as counted by getIkeaIdCount and runkmeans),
+    the countries, the years, and the ranges of max_cm and min_cm
+    the index is written into summary_file if it is given
+    '''
+    print("summarize ", json_file, " by item name")
+    summary = {}
+    ikeaids = {}
+    for e in metrics_counted(entries_read(json_file)):
+        if 'name' not in e:
+            continue
+        name = e.get('name')
+        if name not in summary:
+            summary[name] = {'entries': 0, 'ikeaid_count': 0, 'valid': 0, 'countries': set(), 'years': set(), 'max_cm': None, 'min_cm': None}
+            ikeaids[name] = set()
+        stats = summary[name]
+        stats['entries'] += 1
+        stats['countries'].add(e.get('country'))
+        stats['years'].add(e.get('year'))
+        if 'ikeaid' in e and 'max_cm' in e and 'min_cm' in e:
+            ikeaids[name].add(e.get('ikeaid'))
+        if 'max_cm' in e and 'min_cm' in e:
+            stats['valid'] += 1
+            for field in ['max_cm', 'min_cm']:
+                value = e.get(field)
+                stats[field] = [value, value] if stats[field] is None else [min(stats[field][0], value), max(stats[field][1], value)]
+
+    for (name, stats) in summary.items():
+        stats['ikeaid_count'] = len(ikeaids[name])
+        stats['countries'] = sorted(stats['countries'], key = str)
+        stats['years'] = sorted(stats['years'], key = str)
+
+    if summary_file != None:
+        writeJsonFiles(summary_file, summary)
+    return summary
+
 def getIkeaIdCount(filepath):
     '''
     get the number of different given ikeaid of a file
     '''
-    d = json.loads(open(filepath, 'r').read())
-    entries = d['entries']
-    ikeaid = []
-    for e in entries:
+    ikeaid = set()
+    for e in readEntries(filepath):
         if 'ikeaid' in e and 'max_cm' in e and 'min_cm' in e:
-            if e.get('ikeaid') not in ikeaid:
-                ikeaid.append(e.get('ikeaid'))
+            ikeaid.add(e.get('ikeaid'))
     return len(ikeaid)
 
 
+@metrics_instrumented("kmeans_compare_modes")
+def compareKmeansModes(input_dir, report_file, threshold = 0):
+    '''
+    for every json file with more than threshold valid items, compare the error (and time) of full-batch kmeans and of mini-batch kmeans on the same points,
+    using the count of Ikea ID as k, and write the comparison into report_file
+    '''
+    report = []
+    for json_file in metrics_counted(listEntryFiles(input_dir), 'names'):
+        cluster_number = getIkeaIdCount(input_dir + json_file)
+        (entries, points) = loadPoints(input_dir, json_file)
+        if cluster_number == 0 or len(points) <= threshold:
+            continue
+        start = time.time()
+        full = cluster.KMeans(init = 'k-means++', n_clusters = cluster_number).fit(points).inertia_
+        fullSeconds = time.time() - start
+        start = time.time()
+        minibatch = minibatchError(input_dir, json_file, minibatchKmeans(input_dir, json_file, cluster_number).cluster_centers_)
+        minibatchSeconds = time.time() - start
+        report.append({'file': json_file, 'items': len(points), 'k': cluster_number,
+                       'full_error': full, 'minibatch_error': minibatch, 'error_ratio': (minibatch / full) if full > 0 else None,
+                       'full_seconds': fullSeconds, 'minibatch_seconds': minibatchSeconds})
+        print(json_file, " full error ", full, ", mini-batch error ", minibatch)
+
+    writeJsonFiles(report_file, sorted(report, key = lambda r: r['items'], reverse = True))
+
+@metrics_instrumented("kmeans_store_ikeaid_count")
+def kmeansStoreBasedOnIkeaIdCount(store_dir, json_file):
+    '''
+    Use the count of Ikea ID of every name in a columnar store (see store.py) as the parameter k of its kmeans
+    only the errors are recorded; the points of each name are sliced from the memory-mapped store
+    '''
+    print("start kmeans on store ", store_dir)
+    store = Store(store_dir)
+    errordic = {}
+    for name in metrics_counted(store.names(), 'names'):
+        cluster_number = store.ikeaid_count(name)
+        if cluster_number != 0:
+            error = cluster.KMeans(init = 'k-means++', n_clusters = cluster_number).fit(store.points(name)).inertia_
+        else:
+            error = -1
+        errordic.setdefault(str(cluster_number), []).append(error)
+
+    writeJsonFiles(json_file, sorted(errordic.items(), key = lambda x: x[0], reverse = True))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-gi", action = "store", help = "input file argument")
-    parser.add_argument("-go", action = "store", help = "output directory argument")
+    parser.add_argument("-go", action = "store", help = "output directory argument (optional export of one file per name)")
+    parser.add_argument("-gc", action = "store", help = "output container argument")
     parser.add_argument("-iid", action = "store", help = "the input directory of run kmeans on Ikea ID count")
     parser.add_argument("-oid", action = "store", help = "the output directory of run kmeans on IKea ID count")
+    parser.add_argument("-sid", action = "store", help = "the store directory of run kmeans on Ikea ID count")
+    parser.add_argument("-sof", action = "store", help = "the output file of run kmeans on Ikea ID count over a store")
+    parser.add_argument("-mi", action = "store", help = "the input directory of comparing full-batch and mini-batch kmeans")
+    parser.add_argument("-mo", action = "store", help = "the output file of comparing full-batch and mini-batch kmeans")
+    parser.add_argument("-si", action = "store", help = "the input file of summarizing every item name")
+    parser.add_argument("-so", action = "store", help = "the output file of summarizing every item name")
+    parser.add_argument("-sum", action = "store", help = "a summary file from which run kmeans on Ikea ID count takes the counts")
     parser.add_argument("-ik", action = "store", help = "the input directory of run kmeans on given k")
     parser.add_argument("-ok", action = "store", help = "the output directory of run kmeans on given k")
     parser.add_argument("-low", action = "store", help = "give a lower bound of k")
     parser.add_argument("-high", action = "store", help = "give a higher bound of k")
     parser.add_argument("-incre", action = "store", help = "set the increment, should be positive")
+    parser.add_argument("-writek", action = "store", type = int, nargs = "*", default = [], help = "the k values for which to write the labelled results of run kmeans on given k")
+    parser.add_argument("-workers", action = "store", type = int, default = 1, help = "the number of processes running kmeans on different names")
+    parser.add_argument("-metrics", action = "store", help = "the file to which to append a JSON metrics record for every stage (- for stderr)")
+    parser.add_argument("-profile", action = "store", help = "the directory into which to write a cProfile profile of every stage (with -metrics)")
+    parser.add_argument("-tracemalloc", action = "store_true", default = None, help = "also trace the peak memory allocated by every stage (with -metrics)")
 
     try:
         args = parser.parse_args()
     except IOError:
         pass
+    metrics_configure(args.metrics, args.profile, args.tracemalloc)
 
-    if args.gi != None and args.go != None:
-        groupByName(args.gi, args.go)
+    if args.gi != None and (args.go != None or args.gc != None):
+        groupByName(args.gi, args.go, container = args.gc)
+    if args.si != None and args.so != None:
+        nameSummary(args.si, args.so)
     if args.iid != None and args.oid != None:
-        kmeansBasedOnIkeaIdCount(args.iid, args.oid)
+        kmeansBasedOnIkeaIdCount(args.iid, args.oid, args.workers, args.sum)
+    if args.sid != None and args.sof != None:
+        kmeansStoreBasedOnIkeaIdCount(args.sid, args.sof)
+    if args.mi != None and args.mo != None:
+        compareKmeansModes(args.mi, args.mo)
     if int(args.incre) <= 0:
         print("Increment should be positive")
     elif int(args.low) <= 0:
@@ -294,11 +699,11 @@ def main():
     elif int(args.low >= args.high):
         print("The higher bound shoule be larger than lower bound")
     else:
-        iterkemansDirectory(args.ik, args.ok, int(args.low), int(args.high), int(args.incre))
+        iterkemansDirectory(args.ik, args.ok, int(args.low), int(args.high), int(args.incre), args.workers, args.writek)
 
 
 if __name__ == '__main__':
-    cProfile.runctx('main()', globals(), locals())
+    main()
 
 '''
 def example():
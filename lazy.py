@@ -0,0 +1,68 @@
+###############################################################################
+##
+## lazy.py
+##
+##   Lazily loaded modules and configuration, so that the scripts (and the
+##   command line interface in cli.py) only import their heavy dependencies
+##   and read the configuration file once an operation actually uses them.
+##   The configuration file is config.json in the working directory unless
+##   the IKEA_CONFIG environment variable names another one (which worker
+##   processes inherit as well).
+##
+##
+
+import importlib
+import json
+import os
+from collections.abc import Mapping
+
+###############################################################################
+##
+
+CONFIG_FILE = 'config.json'
+
+def config_file():
+    return os.environ.get('IKEA_CONFIG') or CONFIG_FILE
+
+class LazyConfig(Mapping):
+    '''
+    The configuration, read from the configuration file when it is first
+    used and then kept.
+    '''
+    def __init__(self):
+        self.config = None
+
+    def load(self):
+        if self.config is None:
+            self.config = json.loads(open(config_file()).read())
+        return self.config
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+class LazyModule():
+    '''
+    Stand-in for a module that is only imported (after calling the setup
+    function, if one is specified) when one of its attributes is first used.
+    '''
+    def __init__(self, name, setup = None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        if self._module is None:
+            if self._setup is not None:
+                self._setup()
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+#eof
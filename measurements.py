@@ -1,5 +1,5 @@
 ###############################################################################
-## 
+##
 ## measurements.py
 ##
 ##   Classes for working with individual measurements, measurement ranges, and
@@ -8,15 +8,71 @@
 ##
 
 import re
+from array import array
+
+import numpy as np
 
 ###############################################################################
 ##
 
+def parse_prime_double_prime(raw):
+    (feet, inches) = raw.split("'")
+    inches = inches[:-1] if inches[-1] == '"' else inches
+    return (float(feet)*12) + (float(inches))
+
+def parse_prime(raw):
+    return float(raw[0:-1])*12
+
+def parse_mixed(raw):
+    (term, frac) = raw.strip().split(" ")
+    (numerator, denominator) = frac.split("/")
+    return (float(term)*float(denominator) + float(numerator))/float(denominator)
+
+def parse_fraction(raw):
+    (numerator, denominator) = raw.split("/")
+    return float(numerator)/float(denominator)
+
+def parse_decimal(raw):
+    return float(raw)
+
+# Conversion table for every valid combination of notation and unit. Each
+# raw string is parsed into a magnitude, from which the measurement is
+# computed as:
+#
+#   cm = magnitude * cm_mul
+#   inches = (cm if from_cm else magnitude) * in_mul / in_div
+#
+# The prime notations denote feet and inches whatever the unit is.
+CONVERSIONS_ANY_UNIT = {
+    'prime_double_prime': (parse_prime_double_prime, 2.54, False, 1.0, 1.0),
+    'prime': (parse_prime, 2.54, False, 1.0, 1.0)
+}
+CONVERSIONS = {
+    ('decimal_mixed', 'in'): (parse_mixed, 2.54, False, 1.0, 1.0),
+    ('mixed', 'in'): (parse_mixed, 2.54, False, 1.0, 1.0),
+    ('fraction', 'in'): (parse_fraction, 2.54, False, 1.0, 1.0)
+}
+for notation in ['decimal', 'integer']:
+    CONVERSIONS[(notation, 'mm')] = (parse_decimal, 0.1, False, 1.0, 25.4)
+    CONVERSIONS[(notation, 'cm')] = (parse_decimal, 1.0, True, 1.0, 2.54)
+    CONVERSIONS[(notation, 'm')] = (parse_decimal, 100.0, True, 1.0, 2.54)
+    CONVERSIONS[(notation, 'in')] = (parse_decimal, 2.54, False, 1.0, 1.0)
+    CONVERSIONS[(notation, 'ft')] = (parse_decimal, 30.48, False, 12.0, 1.0)
+
+def conversion(notation, unit):
+    '''
+    The conversion table entry for a notation and unit (None if a raw
+    string in that notation cannot be interpreted in that unit).
+    '''
+    return CONVERSIONS_ANY_UNIT.get(notation) or CONVERSIONS.get((notation, unit))
+
 class Measurement():
     '''
     Class for creating, representing, and normalizing individual measurements
     as quantities.
     '''
+    __slots__ = ('raw', 'notation', 'cm', 'inches')
+
     def __init__(self, raw, notation):
         self.raw = raw
         self.notation = notation
@@ -28,47 +84,13 @@ class Measurement():
         Use the unit information to parse the raw string
         representation into a numerical data type.
         '''
-        if self.notation == 'prime_double_prime':
-            (feet, inches) = self.raw.split("'")
-            inches = inches[:-1] if inches[-1] == '"' else inches
-            self.inches = (float(feet)*12) + (float(inches))
-            self.cm = self.inches * 2.54
-        elif self.notation == 'prime':
-            self.inches = float(self.raw[0:-1])*12
-            self.cm = self.inches * 2.54
-        elif self.notation == 'decimal_mixed' and unit == "in":
-            (term, frac) = self.raw.strip().split(" ")
-            (numerator, denominator) = frac.split("/")
-            self.inches = (float(term)*float(denominator) + float(numerator))/float(denominator)
-            self.cm = self.inches * 2.54
-        elif self.notation == 'mixed' and unit == "in":
-            (term, frac) = self.raw.strip().split(" ")
-            (numerator, denominator) = frac.split("/")
-            self.inches = (float(term)*float(denominator) + float(numerator))/float(denominator)
-            self.cm = self.inches * 2.54
-        elif self.notation == 'fraction' and unit == "in":
-            (numerator, denominator) = self.raw.split("/")
-            self.inches = float(numerator)/float(denominator)
-            self.cm = self.inches * 2.54
-        elif self.notation in ['decimal', 'integer'] and unit == "mm":
-            self.cm = float(self.raw)*0.1
-            self.inches = float(self.raw) / 25.4
-        elif self.notation in ['decimal', 'integer'] and unit == "cm":
-            self.cm = float(self.raw)
-            self.inches = self.cm / 2.54
-        elif self.notation in ['decimal', 'integer'] and unit == "m":
-            self.cm = float(self.raw)*100
-            self.inches = self.cm / 2.54
-        elif self.notation in ['decimal', 'integer'] and unit == "in":
-            self.cm = float(self.raw)*2.54
-            self.inches = float(self.raw)
-        elif self.notation in ['decimal', 'integer'] and unit == "ft":
-            self.cm =  float(self.raw)*30.48
-            self.inches = float(self.raw)*12
-        else:
+        entry = conversion(self.notation, unit)
+        if entry is None:
             return False
-
-        # One of the non-else branches above succeeded.
+        (parse, cm_mul, from_cm, in_mul, in_div) = entry
+        magnitude = parse(self.raw)
+        self.cm = magnitude * cm_mul
+        self.inches = (self.cm if from_cm else magnitude) * in_mul / in_div
         return True
 
     def __str__(self):
@@ -111,33 +133,150 @@ class Measurement():
 class Assortment():
     '''
     Class for creating, representing, and normalizing and
-    assortment of explicit measurement quantities.
+    assortment of explicit measurement quantities. The raw
+    strings and notations are kept in lists and the converted
+    values in arrays; Measurement objects are only built on
+    request, as views of these.
     '''
+    __slots__ = ('_raws', '_notations', 'cms', 'inches')
+
     def __init__(self):
-        self.measurements = []
+        self._raws = []
+        self._notations = []
+        self.cms = None
+        self.inches = None
 
     def __bool__(self):
-        return len(self.measurements) > 0
+        return len(self._raws) > 0
+
+    def __len__(self):
+        return len(self._raws)
+
+    def append(self, raw, notation):
+        self._raws.append(raw)
+        self._notations.append(notation)
+        self.cms = self.inches = None
 
     def add(self, measurement):
-        self.measurements.append(measurement)
+        self.append(measurement.raw, measurement.notation)
 
     def set_unit(self, unit):
-        result = all([m.set_unit(unit) for m in self.measurements])
-        if result:
-            self.measurements.sort()
-        return result
+        '''
+        Convert every raw string using the unit information; fails (and
+        leaves the assortment unconverted) if any of them cannot be.
+        '''
+        (cms, inches, converted) = (array('d'), array('d'), True)
+        for (raw, notation) in zip(self._raws, self._notations):
+            entry = conversion(notation, unit)
+            if entry is None:
+                converted = False
+                continue
+            (parse, cm_mul, from_cm, in_mul, in_div) = entry
+            magnitude = parse(raw)
+            cms.append(magnitude * cm_mul)
+            inches.append((cms[-1] if from_cm else magnitude) * in_mul / in_div)
+        if converted:
+            (self.cms, self.inches) = (cms, inches)
+        return converted
 
     def raws(self):
-        return [m.raw for m in self.measurements]
+        return list(self._raws)
 
     def notations(self):
-        return [m.notation for m in self.measurements]
+        return list(self._notations)
+
+    def measurement(self, i):
+        m = Measurement(self._raws[i], self._notations[i])
+        if self.cms is not None:
+            (m.cm, m.inches) = (self.cms[i], self.inches[i])
+        return m
+
+    @property
+    def measurements(self):
+        return [self.measurement(i) for i in range(len(self._raws))]
+
+    def min_cm(self):
+        return min(self.cms)
+
+    def max_cm(self):
+        return max(self.cms)
 
     def min(self):
-        return min(self.measurements)
+        return self.measurement(min(range(len(self.cms)), key = self.cms.__getitem__))
 
     def max(self):
-        return max(self.measurements)
-    
-#eof
\ No newline at end of file
+        return self.measurement(max(range(len(self.cms)), key = self.cms.__getitem__))
+
+###############################################################################
+##  Vectorized conversion of batches of measurements.
+
+NOTATION_CODES = {n:i for (i, n) in enumerate(sorted(set(CONVERSIONS_ANY_UNIT) | {n for (n, u) in CONVERSIONS}))}
+UNIT_CODES = {u:i for (i, u) in enumerate(sorted({u for (n, u) in CONVERSIONS}))} # Any other unit has the last code.
+
+def conversion_tables():
+    '''
+    Arrays indexed by notation code and unit code holding the
+    conversion table entries (and whether each entry exists).
+    '''
+    shape = (len(NOTATION_CODES), len(UNIT_CODES) + 1)
+    tables = {'valid': np.zeros(shape, dtype = bool), 'cm_mul': np.ones(shape), 'from_cm': np.zeros(shape, dtype = bool),\
+              'in_mul': np.ones(shape), 'in_div': np.ones(shape)}
+    for (notation, n) in NOTATION_CODES.items():
+        for (unit, u) in list(UNIT_CODES.items()) + [(None, len(UNIT_CODES))]:
+            entry = conversion(notation, unit)
+            if entry is not None:
+                (parse, tables['cm_mul'][n, u], tables['from_cm'][n, u], tables['in_mul'][n, u], tables['in_div'][n, u]) = entry
+                tables['valid'][n, u] = True
+    return tables
+
+CONVERSION_TABLES = conversion_tables()
+
+def measurements_convert(raws, notations, units):
+    '''
+    Convert a batch of measurements, given as parallel sequences of raw
+    strings, notations, and units, using the vectorized conversion tables.
+    Returns arrays of the values in centimeters and in inches along with a
+    mask of the measurements that could be converted (the values of the
+    others are NaN). Every converted value is identical to the one that
+    Measurement.set_unit computes.
+    '''
+    n = np.array([NOTATION_CODES.get(notation, -1) for notation in notations], dtype = np.int64)
+    u = np.array([UNIT_CODES.get(unit, len(UNIT_CODES)) for unit in units], dtype = np.int64)
+    valid = (n >= 0) & CONVERSION_TABLES['valid'][np.maximum(n, 0), u]
+    magnitudes = np.array([conversion(notation, unit)[0](raw) if ok else np.nan\
+                           for (raw, notation, unit, ok) in zip(raws, notations, units, valid)], dtype = np.float64)
+    n = np.maximum(n, 0)
+    cms = magnitudes * CONVERSION_TABLES['cm_mul'][n, u]
+    inches = np.where(CONVERSION_TABLES['from_cm'][n, u], cms, magnitudes) * CONVERSION_TABLES['in_mul'][n, u] / CONVERSION_TABLES['in_div'][n, u]
+    return (cms, inches, valid)
+
+def assortments_convert(raws, notations, units, offsets):
+    '''
+    Convert a batch of assortments, given as flat sequences of the raw
+    strings, notations, and units of all their measurements along with the
+    offsets at which each assortment starts (and a final offset at which the
+    last one ends). Returns a mask of the non-empty assortments in which every
+    measurement could be converted, along with the minimum and maximum
+    values in centimeters of every assortment (computed without sorting).
+    '''
+    (cms, inches, valid) = measurements_convert(raws, notations, units)
+    offsets = np.asarray(offsets, dtype = np.int64)
+    (starts, ends) = (offsets[:-1], offsets[1:])
+    if len(cms) == 0:
+        return (np.zeros(len(starts), dtype = bool), np.full(len(starts), np.nan), np.full(len(starts), np.nan))
+
+    # Reduce over the non-empty assortments only (a reduction at the start
+    # of an empty one would cut the preceding one short), and scatter the
+    # results back into place; the empty assortments remain masked.
+    nonempty = ends > starts
+    (converted, min_cm, max_cm) = (np.zeros(len(starts), dtype = bool), np.full(len(starts), np.nan), np.full(len(starts), np.nan))
+    if not nonempty.any():
+        return (converted, min_cm, max_cm)
+    (cms, valid) = (cms[:offsets[-1]], valid[:offsets[-1]])
+    starts = starts[nonempty]
+    converted[nonempty] = np.logical_and.reduceat(valid, starts)
+    min_cm[nonempty] = np.where(converted[nonempty], np.minimum.reduceat(cms, starts), np.nan)
+    max_cm[nonempty] = np.where(converted[nonempty], np.maximum.reduceat(cms, starts), np.nan)
+    return (converted, min_cm, max_cm)
+
+#eof
@@ -0,0 +1,219 @@
+###############################################################################
+##
+## metrics.py
+##
+##   Opt-in instrumentation of the stages of the scripts. Once switched on
+##   (by the IKEA_METRICS environment variable, or by metrics_configure from a
+##   command line flag), every stage emits a JSON metrics record with its
+##   running time, the number of entries it processed and their throughput,
+##   and the peak resident memory sampled while it ran, optionally along with
+##   a cProfile profile and the peak memory traced by tracemalloc:
+##
+##     IKEA_METRICS=metrics.jsonl python kmeans.py ...   (or "-" for stderr)
+##     IKEA_METRICS_PROFILE=profiles/                     (a .prof file per stage)
+##     IKEA_METRICS_TRACEMALLOC=1
+##
+##   When switched off, the stages run exactly as they otherwise would.
+##
+##
+
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource # Not available on every platform.
+except ImportError:
+    resource = None
+
+###############################################################################
+##
+
+METRICS = {
+    'output': os.environ.get('IKEA_METRICS') or None,
+    'profile': os.environ.get('IKEA_METRICS_PROFILE') or None,
+    'tracemalloc': os.environ.get('IKEA_METRICS_TRACEMALLOC') not in {None, "", "0"}
+}
+RSS_SAMPLE_SECONDS = 0.05
+STAGES = [] # The stages running, innermost last.
+
+def metrics_configure(output = None, profile = None, trace_memory = None):
+    '''
+    Switch on the metrics records (written to the output file, or to
+    stderr if it is "-"), the profiles (written into the profile
+    directory), or the tracing of memory allocations.
+    '''
+    if output is not None:
+        METRICS['output'] = output
+    if profile is not None:
+        METRICS['profile'] = profile
+    if trace_memory is not None:
+        METRICS['tracemalloc'] = trace_memory
+
+def metrics_enabled():
+    return METRICS['output'] is not None
+
+def rss_peak_bytes(who = None):
+    '''
+    The peak resident memory of this process (or of its terminated child
+    processes) so far, or None if it cannot be determined.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # In kilobytes except on macOS.
+
+def rss_bytes():
+    '''
+    The current resident memory of this process (or the peak so far where
+    it cannot be read).
+    '''
+    try:
+        with open("/proc/self/statm") as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return rss_peak_bytes()
+
+class RssSampler(threading.Thread):
+    '''
+    Thread sampling the resident memory of the process at regular
+    intervals to find its peak while a stage runs.
+    '''
+    def __init__(self, interval = RSS_SAMPLE_SECONDS):
+        threading.Thread.__init__(self, daemon = True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak = rss_bytes()
+
+    def sample(self):
+        rss = rss_bytes()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+class Stage():
+    '''
+    The measurements of a running stage, which become its metrics record
+    once it stops. Only the outermost running stage is profiled and has
+    its allocations traced, as neither can be nested.
+    '''
+    def __init__(self, name, fields):
+        self.record = dict(fields, stage = name, pid = os.getpid())
+        self.counts = {}
+        self.profiler = None
+        self.tracing = False
+
+    def start(self):
+        outermost = len(STAGES) == 1
+        if outermost and METRICS['tracemalloc'] and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        if outermost and METRICS['profile'] is not None:
+            self.profiler = cProfile.Profile()
+        self.sampler = RssSampler()
+        self.sampler.start()
+        self.record['start'] = time.time()
+        self.started = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self):
+        seconds = time.perf_counter() - self.started
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(METRICS['profile'], exist_ok = True)
+            self.record['profile'] = os.path.join(METRICS['profile'], self.record['stage'] + "-" + str(os.getpid()) + "-" + str(int(self.record['start'])) + ".prof")
+            self.profiler.dump_stats(self.record['profile'])
+        if self.tracing:
+            (current, self.record['traced_peak_bytes']) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.record['seconds'] = seconds
+        for (what, count) in self.counts.items():
+            self.record[what] = count
+            self.record[what + '_per_second'] = count / seconds if seconds > 0 else None
+        self.record['peak_rss_bytes'] = self.sampler.stop()
+        self.record['max_rss_bytes'] = rss_peak_bytes()
+        if resource is not None:
+            self.record['children_max_rss_bytes'] = rss_peak_bytes(resource.RUSAGE_CHILDREN)
+        return self.record
+
+def metrics_emit(record):
+    line = json.dumps(record, sort_keys = True, default = str)
+    if METRICS['output'] == "-":
+        print(line, file = sys.stderr, flush = True)
+    else:
+        with open(METRICS['output'], 'a') as handle:
+            handle.write(line + "\n")
+
+@contextmanager
+def metrics_stage(name, **fields):
+    '''
+    Measure the enclosed stage, emitting its metrics record (along with
+    the given fields) once it finishes or fails. Yields None if the
+    metrics are switched off.
+    '''
+    if not metrics_enabled():
+        yield None
+        return
+    stage = Stage(name, fields)
+    STAGES.append(stage)
+    stage.start()
+    try:
+        yield stage
+    except BaseException as e:
+        stage.record['error'] = type(e).__name__
+        raise
+    finally:
+        STAGES.pop()
+        metrics_emit(stage.stop())
+
+def metrics_instrumented(name):
+    '''
+    Decorator measuring every call of a function as a stage.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def instrumented(*args, **kwargs):
+            if not metrics_enabled():
+                return f(*args, **kwargs)
+            with metrics_stage(name):
+                return f(*args, **kwargs)
+        return instrumented
+    return decorator
+
+def metrics_count(count, what = 'entries'):
+    '''
+    Add to a count (and thereby throughput) of the innermost running stage.
+    '''
+    if STAGES:
+        STAGES[-1].counts[what] = STAGES[-1].counts.get(what, 0) + count
+
+def metrics_counted(items, what = 'entries'):
+    '''
+    Count the items of an iterable as they are consumed by the innermost
+    running stage (returning the iterable itself if there is none).
+    '''
+    if not STAGES:
+        return items
+    def counted(stage):
+        for item in items:
+            stage.counts[what] = stage.counts.get(what, 0) + 1
+            yield item
+    return counted(STAGES[-1])
+
+#eof
@@ -0,0 +1,103 @@
+###############################################################################
+##
+## partitions.py
+##
+##   Container for a data set partitioned by product name. The entries of
+##   every name are written as one contiguous block of JSON Lines in one of a
+##   few shard files, and an index records the shard, byte offset, length,
+##   and entry count of every block, so the entries of a single name can be
+##   read without reading any others.
+##
+##
+
+import json
+import os
+import zlib
+
+###############################################################################
+##
+
+def partition_file_name(name):
+    '''
+    The name of the file to which the entries with the given name were
+    written by the original file-per-name partitioning.
+    '''
+    return name.replace("/", "_") + ".json"
+
+def partition_shard(name, shards):
+    return zlib.crc32(name.encode()) % shards
+
+def partitions_write(partitions, directory, shards = 8):
+    '''
+    Write a dictionary from names to lists of entries into a container
+    directory holding the shard files and the index. Returns the number
+    of entries written.
+    '''
+    os.makedirs(directory, exist_ok = True)
+    handles = [open(os.path.join(directory, "shard-" + str(i) + ".jsonl"), 'wb') for i in range(shards)]
+    index = []
+    count = 0
+    for (name, entries) in partitions.items():
+        shard = partition_shard(name, shards)
+        block = "".join(json.dumps(e, sort_keys=True) + "\n" for e in entries).encode()
+        index.append([name, shard, handles[shard].tell(), len(block), len(entries)])
+        handles[shard].write(block)
+        count += len(entries)
+    for handle in handles:
+        handle.close()
+    open(os.path.join(directory, "index.json"), 'w').write(json.dumps({'shards': shards, 'partitions': index}))
+    return count
+
+def is_partitions(directory):
+    return os.path.isfile(os.path.join(directory, "index.json"))
+
+class Partitions():
+    '''
+    Class for reading a container written by partitions_write. Partitions
+    can be looked up by name or by the name of the file that the original
+    file-per-name partitioning would have written them to.
+    '''
+    def __init__(self, directory):
+        index = json.loads(open(os.path.join(directory, "index.json")).read())
+        self.directory = directory
+        self.shards = index['shards']
+        self.index = {name: (shard, offset, length, count) for (name, shard, offset, length, count) in index['partitions']}
+        self.file_to_name = {partition_file_name(name): name for name in self.index}
+
+    def names(self):
+        return list(self.index)
+
+    def file_names(self):
+        return list(self.file_to_name)
+
+    def count(self, name):
+        return self.index[name][3]
+
+    def read(self, name):
+        '''
+        The entries with the given name, read directly from their block.
+        '''
+        (shard, offset, length, count) = self.index[name]
+        with open(os.path.join(self.directory, "shard-" + str(shard) + ".jsonl"), 'rb') as handle:
+            handle.seek(offset)
+            block = handle.read(length)
+        return [json.loads(line) for line in block.decode().splitlines()]
+
+    def stream(self, name):
+        '''
+        Generate the entries with the given name one at a time, reading
+        their block one line at a time.
+        '''
+        (shard, offset, length, count) = self.index[name]
+        with open(os.path.join(self.directory, "shard-" + str(shard) + ".jsonl"), 'rb') as handle:
+            handle.seek(offset)
+            for _ in range(count):
+                yield json.loads(handle.readline())
+
+    def read_file(self, file_name):
+        return self.read(self.file_to_name[file_name])
+
+    def stream_file(self, file_name):
+        return self.stream(self.file_to_name[file_name])
+
+#eof
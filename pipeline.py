@@ -0,0 +1,249 @@
+###############################################################################
+##
+## pipeline.py
+##
+##   Runner for the sequence of stages that converts the legacy workbooks into
+##   the final spreadsheet (see example() in data.py). Every stage declares the
+##   files it reads (including config.json and colors.translations.json) and
+##   writes; a stage is only skipped if the contents of its inputs and outputs
+##   are those recorded when it last completed (so that the partial outputs
+##   of an interrupted stage are never taken as up to date). Stages that do
+##   not depend on each other (such as the color map and the projection,
+##   which only read data.json) run side by side, e.g.:
+##
+##     python pipeline.py -source data/ -parallel 2
+##     python pipeline.py -source data/ -dry-run
+##
+##
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+
+import data # Project-specific package.
+from lazy import config_file # Project-specific package.
+
+###############################################################################
+##
+
+class Stage():
+    '''
+    A stage of the pipeline: a (picklable) function called with the given
+    arguments, which reads the input files and writes the output files.
+    '''
+    def __init__(self, name, function, arguments, inputs, outputs):
+        self.name = name
+        self.function = function
+        self.arguments = arguments
+        self.inputs = [os.path.normpath(path) for path in inputs]
+        self.outputs = [os.path.normpath(path) for path in outputs]
+
+    def run(self):
+        self.function(*self.arguments)
+
+def workbook_files(source, countries, years):
+    '''
+    The workbook files (one per country and year) that ingestion reads.
+    '''
+    files = []
+    for country in countries:
+        for year in years:
+            for ext in ["xlsx", "XLSX", "xls", "XLS"]:
+                if os.path.isfile(source + country + str(year) + "." + ext):
+                    files.append(source + country + str(year) + "." + ext)
+    return files
+
+def pipeline_stages(source = "data/", directory = "", workers = 1, incremental = False):
+    '''
+    The stages converting the workbooks under source into the files written
+    into directory (the working directory by default), in the order of
+    example() in data.py.
+    '''
+    (config, translations) = (config_file(), 'colors.translations.json')
+    path = lambda name: os.path.join(directory, name)
+    workbooks = workbook_files(os.path.join(source, ""), data.CONFIG['countries'], data.CONFIG['years'])
+    return [
+        Stage('ingest', data.xlsx_files_to_json_file, (os.path.join(source, ""), path('data.json'), True, None, None, workers),\
+              workbooks + [config], [path('data.json')]),
+        Stage('colors', data.json_to_color_map, (path('data.json'), path('colors.json')),\
+              [path('data.json'), config, translations], [path('colors.json')]),
+        Stage('projections', data.projections_add, (path('data.json'), path('projected.json'), 100000, None, workers, 1000, incremental),\
+              [path('data.json'), config], [path('projected.json')] + ([data.projection_fingerprints_path(path('projected.json'))] if incremental else [])),
+        Stage('groups', data.derive_ad_hoc_groups, (path('projected.json'), path('grouped.json')),\
+              [path('projected.json')], [path('grouped.json')]),
+        Stage('xlsx', data.json_file_to_xlsx_file, (path('grouped.json'), path('grouped.xlsx')),\
+              [path('grouped.json'), config], [path('grouped.xlsx')])
+    ]
+
+def pipeline_upstream(stages):
+    '''
+    The names of the stages that write an input of every stage.
+    '''
+    writers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {stage.name: {writers[path] for path in stage.inputs if path in writers and writers[path] != stage.name} for stage in stages}
+
+def file_digest(path, known = None):
+    '''
+    The SHA-256 digest of the contents of a file, reusing the digest in
+    the known [size, mtime, digest] record if the file has not changed since.
+    '''
+    status = os.stat(path)
+    if known is not None and known[:2] == [status.st_size, status.st_mtime_ns]:
+        return known
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return [status.st_size, status.st_mtime_ns, digest.hexdigest()]
+
+def files_digests(paths, known = None):
+    known = {} if known is None else known
+    return {path: file_digest(path, known.get(path)) for path in paths if os.path.isfile(path)}
+
+def stage_status(stage, record):
+    '''
+    Whether a stage is up to date and why, given the digests recorded when
+    it last completed (if it did). It is only up to date if it reads the
+    same inputs (e.g. no workbook was added or removed) and the digests of
+    its inputs and outputs match the recorded ones. If the digests had to
+    be compared, they are also returned (with the current sizes and times
+    of the files, so that the files are not digested again until they
+    change).
+    '''
+    missing = [path for path in stage.outputs if not os.path.isfile(path)]
+    if len(missing) > 0:
+        return (False, missing[0] + " is missing", None)
+    missing = [path for path in stage.inputs if not os.path.isfile(path)]
+    if len(missing) > 0:
+        return (False, "input " + missing[0] + " is missing", None)
+    if record is None:
+        return (False, "no completed run is recorded", None)
+    if set(stage.inputs) != set(record['inputs']):
+        (added, removed) = (sorted(set(stage.inputs) - set(record['inputs'])), sorted(set(record['inputs']) - set(stage.inputs)))
+        return (False, "input " + (added[0] + " was added" if len(added) > 0 else removed[0] + " was removed"), None)
+    current = {'inputs': files_digests(stage.inputs, record['inputs']), 'outputs': files_digests(stage.outputs, record['outputs'])}
+    changed = [path for side in ['inputs', 'outputs'] for path in sorted(set(current[side]) | set(record[side]))\
+               if path not in current[side] or path not in record[side] or current[side][path][2] != record[side][path][2]]
+    if len(changed) > 0:
+        return (False, changed[0] + " changed", current)
+    return (True, "contents are unchanged", current)
+
+def files_listed(paths):
+    return ", ".join(paths) if len(paths) <= 4 else ", ".join(paths[:2]) + ", ... (" + str(len(paths)) + " files)"
+
+def pipeline_state_file(directory):
+    return os.path.join(directory, "pipeline.state.json")
+
+def pipeline_state(state_file):
+    return json.loads(open(state_file).read()) if os.path.isfile(state_file) else {}
+
+def pipeline_plan(stages, state, force = False):
+    '''
+    The plan of the pipeline, as (stage, action, reason) triples in order.
+    A stage after one that will run can only be assessed once that one has
+    run (it is skipped then if its inputs turn out to be unchanged).
+    '''
+    upstream = pipeline_upstream(stages)
+    (plan, running) = ([], set())
+    for stage in stages:
+        waiting = sorted(upstream[stage.name] & running)
+        if force:
+            (action, reason) = ("run", "forced")
+        elif len(waiting) > 0:
+            (action, reason) = ("run", "if the outputs of " + ", ".join(waiting) + " change")
+        else:
+            (up_to_date, reason, current) = stage_status(stage, state.get(stage.name))
+            action = "skip" if up_to_date else "run"
+        if action == "run":
+            running.add(stage.name)
+        plan.append((stage, action, reason))
+    return plan
+
+def pipeline_run(stages, state_file = None, parallel = 1, force = False, dry_run = False):
+    '''
+    Run the stages that are not up to date, as soon as the stages writing
+    their inputs are done, in a pool of parallel processes (or in order in
+    this process if parallel is 1). The digests of the inputs and outputs of
+    every stage that runs are recorded in the state file. Returns the names
+    of the stages that ran.
+    '''
+    state_file = pipeline_state_file("") if state_file is None else state_file
+    state = pipeline_state(state_file)
+    if dry_run:
+        for (stage, action, reason) in pipeline_plan(stages, state, force):
+            print(stage.name + ": " + action + " (" + reason + "); reads " + files_listed(stage.inputs) + "; writes " + files_listed(stage.outputs))
+        return []
+
+    upstream = pipeline_upstream(stages)
+    (pending, running, done, ran) = (list(stages), {}, set(), [])
+
+    def save():
+        open(state_file + ".tmp", 'w').write(json.dumps(state, indent = 2, sort_keys = True))
+        os.replace(state_file + ".tmp", state_file)
+
+    def start(stage, executor):
+        (up_to_date, reason, current) = (False, "forced", None) if force else stage_status(stage, state.get(stage.name))
+        if up_to_date:
+            print("Skipping stage '" + stage.name + "' (" + reason + ").")
+            if current is not None:
+                state[stage.name] = current
+                save()
+            done.add(stage.name)
+            return
+        print("Running stage '" + stage.name + "' (" + reason + ")...")
+        inputs = files_digests(stage.inputs, state.get(stage.name, {}).get('inputs', {}))
+        if stage.name in state:
+            # Until the stage completes, its outputs are not up to date.
+            del state[stage.name]
+            save()
+        if executor is None:
+            stage.run()
+            finish(stage, inputs)
+        else:
+            running[executor.submit(stage.run)] = (stage, inputs)
+
+    def finish(stage, inputs):
+        state[stage.name] = {'inputs': inputs, 'outputs': files_digests(stage.outputs)}
+        save()
+        print("...finished stage '" + stage.name + "'.")
+        done.add(stage.name)
+        ran.append(stage.name)
+
+    with (ProcessPoolExecutor(max_workers = parallel) if parallel != 1 else nullcontext()) as executor:
+        while pending or running:
+            # Start (or skip) every stage whose upstream stages are done.
+            ready = [stage for stage in pending if upstream[stage.name] <= done]
+            if len(ready) > 0:
+                for stage in ready:
+                    pending.remove(stage)
+                    start(stage, executor)
+                continue
+            if not running:
+                raise RuntimeError("Stages " + ", ".join(stage.name for stage in pending) + " depend on each other.")
+            (finished, _) = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                (stage, inputs) = running.pop(future)
+                future.result()
+                finish(stage, inputs)
+    return ran
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-source", action = "store", default = "data/", help = "the directory holding the workbooks")
+    parser.add_argument("-directory", action = "store", default = "", help = "the directory into which to write the outputs (the working directory by default)")
+    parser.add_argument("-parallel", action = "store", type = int, default = 2, help = "the number of stages to run at once")
+    parser.add_argument("-workers", action = "store", type = int, default = 1, help = "the number of processes of the ingestion and the projection")
+    parser.add_argument("-incremental", action = "store_true", help = "project incrementally")
+    parser.add_argument("-force", action = "store_true", help = "run every stage, even if it is up to date")
+    parser.add_argument("-dry-run", action = "store_true", help = "only print the plan of the stages to run and to skip")
+    args = parser.parse_args()
+    stages = pipeline_stages(args.source, args.directory, args.workers, args.incremental)
+    pipeline_run(stages, pipeline_state_file(args.directory), args.parallel, args.force, args.dry_run)
+
+if __name__ == '__main__':
+    main()
+
+#eof
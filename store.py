@@ -0,0 +1,124 @@
+###############################################################################
+##
+## store.py
+##
+##   Columnar store for projected data sets. Numeric fields are kept in NumPy
+##   arrays and the name, country, and ikeaid fields are dictionary-encoded.
+##   Entries are ordered by name, so all entries with a given name form one
+##   contiguous slice described by an offsets table. Stores are loaded as
+##   memory-mapped arrays, so slicing a name's points copies nothing.
+##
+##
+
+import json
+import os
+from array import array
+
+import numpy as np
+
+###############################################################################
+##
+
+STORE_ENCODED = ['name', 'country', 'ikeaid']
+
+def store_write(entries, directory, numeric):
+    '''
+    Write an iterable of entries into a columnar store directory, with one
+    float array per numeric field (NaN where an entry has no numeric value)
+    and one integer code array per dictionary-encoded field (-1 where an
+    entry has no value). Returns the number of entries written.
+    '''
+    os.makedirs(directory, exist_ok = True)
+    values = {field: array('d') for field in numeric}
+    codes = {field: array('q') for field in STORE_ENCODED}
+    vocabs = {field: {} for field in STORE_ENCODED}
+    count = 0
+    for entry in entries:
+        for field in numeric:
+            value = entry.get(field)
+            values[field].append(value if type(value) in {int, float} else float('nan'))
+        for field in STORE_ENCODED:
+            value = entry.get(field)
+            codes[field].append(-1 if value is None else vocabs[field].setdefault(value, len(vocabs[field])))
+        count += 1
+
+    # Order the entries by name (keeping their original order within each
+    # name) and record where the entries for each name start and end.
+    names = np.frombuffer(codes['name'], dtype = np.int64)
+    order = np.argsort(names, kind = 'stable')
+    offsets = np.searchsorted(names[order], np.arange(len(vocabs['name']) + 1))
+
+    np.save(os.path.join(directory, "row.npy"), order.astype(np.int64))
+    np.save(os.path.join(directory, "offsets.npy"), offsets.astype(np.int64))
+    for field in numeric:
+        column = np.frombuffer(values[field], dtype = np.float64)
+        np.save(os.path.join(directory, field + ".npy"), column[order])
+    for field in STORE_ENCODED:
+        column = np.frombuffer(codes[field], dtype = np.int64)
+        np.save(os.path.join(directory, field + ".npy"), column[order].astype(np.int32))
+    meta = {'count': count, 'numeric': numeric, 'vocabularies': {field: list(vocabs[field]) for field in STORE_ENCODED}}
+    open(os.path.join(directory, "meta.json"), 'w').write(json.dumps(meta))
+    return count
+
+class Store():
+    '''
+    Class for reading a columnar store written by store_write. All columns
+    are memory-mapped, so columns and slices of them are views into the
+    files on disk.
+    '''
+    def __init__(self, directory):
+        meta = json.loads(open(os.path.join(directory, "meta.json")).read())
+        self.count = meta['count']
+        self.numeric = meta['numeric']
+        self.vocabularies = meta['vocabularies']
+        self.name_to_index = {name: i for (i, name) in enumerate(self.vocabularies['name'])}
+        self.columns = {field: np.load(os.path.join(directory, field + ".npy"), mmap_mode = 'r')\
+                        for field in self.numeric + STORE_ENCODED + ['row']}
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode = 'r')
+
+    def names(self):
+        return self.vocabularies['name']
+
+    def slice(self, name):
+        '''
+        The range of positions in every column that holds the entries with
+        the given name.
+        '''
+        i = self.name_to_index[name]
+        return slice(int(self.offsets[i]), int(self.offsets[i+1]))
+
+    def column(self, field, name = None):
+        '''
+        A column of numeric values or codes, restricted to the entries with
+        the given name if one is specified.
+        '''
+        return self.columns[field] if name is None else self.columns[field][self.slice(name)]
+
+    def decode(self, field, codes):
+        vocabulary = self.vocabularies[field]
+        return [None if c < 0 else vocabulary[c] for c in codes]
+
+    def valid(self, name):
+        '''
+        Mask of the entries with the given name that have both a max_cm
+        and a min_cm value.
+        '''
+        return ~(np.isnan(self.column('max_cm', name)) | np.isnan(self.column('min_cm', name)))
+
+    def points(self, name):
+        '''
+        The (max_cm, min_cm) points of the entries with the given name that
+        have both values.
+        '''
+        valid = self.valid(name)
+        return np.column_stack((self.column('max_cm', name)[valid], self.column('min_cm', name)[valid]))
+
+    def ikeaid_count(self, name):
+        '''
+        The number of distinct ikeaid values among the entries with the
+        given name that have both a max_cm and a min_cm value.
+        '''
+        ikeaids = self.column('ikeaid', name)[self.valid(name)]
+        return len(np.unique(ikeaids[ikeaids >= 0]))
+
+#eof